@@ -0,0 +1,79 @@
+"""
+Decoding benchmark for mimbus.structures.
+
+Compares the hot path (parse a LoadUserDataAll response and read stamina, level and public uid)
+with the eager models mimbus.structures had before sections were decoded lazily, kept below as they were.
+Exits with a non-zero status when the hot path is not at least `--min-speedup` times faster.
+
+    python -m benchmarks.structures
+"""
+import argparse
+import pathlib
+import sys
+import timeit
+
+import orjson
+import pydantic
+
+from mimbus import structures
+
+PAYLOADS = pathlib.Path(__file__).parent / 'payloads'
+
+
+class EagerUpdate(pydantic.BaseModel):
+    user_info: structures.UserInfo
+    mail_list: list[structures.MailList]
+
+    class Config:
+        alias_generator = structures.to_camel
+
+
+class EagerLoadAllResults(pydantic.BaseModel):
+    profile: structures.Profile
+
+
+class EagerLoadAllResponse(structures.MimbusBaseResponse):
+    updated: EagerUpdate
+    result: EagerLoadAllResults
+
+
+def hot_path(raw: bytes):
+    data = structures.LoadAllResponse.parse_obj(orjson.loads(raw))
+    return data.updated.user_info.stamina, data.result.profile.level, data.result.profile.public_uid
+
+
+def eager_decode(raw: bytes):
+    data = EagerLoadAllResponse.parse_obj(orjson.loads(raw))
+    return data.updated.user_info.stamina, data.result.profile.level, data.result.profile.public_uid
+
+
+def measure(func, raw: bytes, number: int) -> float:
+    return min(timeit.repeat(lambda: func(raw), number=number, repeat=5)) / number
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=2000)
+    parser.add_argument('--min-speedup', type=float, default=3.)
+    args = parser.parse_args()
+
+    raw = (PAYLOADS / 'load_all.json').read_bytes()
+
+    hot = measure(hot_path, raw, args.number)
+    eager = measure(eager_decode, raw, args.number)
+    speedup = eager / hot
+
+    print(f'payload:     {len(raw)} bytes')
+    print(f'hot path:    {hot * 1e6:8.1f} us')
+    print(f'eager:       {eager * 1e6:8.1f} us')
+    print(f'speedup:     {speedup:8.1f}x')
+
+    if speedup < args.min_speedup:
+        print(f'hot path is less than {args.min_speedup}x faster than an eager decode', file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
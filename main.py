@@ -1,16 +1,17 @@
 import asyncio
 import logging
-import random
 from datetime import datetime
 
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.sql import select
 
-from mimbus import proxy, structures, models
+from mimbus import cache, metrics, proxy, structures, models
 from mimbus.automation import AutomationWorker
+from mimbus.broadcast import BroadcastWorker
 from mimbus.client import MimbusClient
+from mimbus.dungeon import DungeonWorker
 from mimbus.config import Config
-from mimbus.exceptions import SteamException
+from mimbus.exceptions import SteamException, TokenServiceUnavailable
 from mimbus.middleware import (
     SessionMiddleware,
     UserMiddleware,
@@ -19,9 +20,17 @@ from mimbus.middleware import (
     LanguageMiddleware,
     StatusMiddleware,
     AdminOnlyMiddleware,
+    UserLockMiddleware,
+    TimedMiddleware,
+    HandlerMetricsMiddleware,
 )
+from mimbus.refresher import TokenRefresher
+from mimbus.sender import MessageSender
 from mimbus.state import AuthState, DungeonState, AdminState
-from mimbus.utils import generate_token, prepare_db, session_scope
+from mimbus.steam import token_service
+from mimbus.storage import GuardSessions, SQLStorage, create_storage
+from mimbus.webhook import run_webhook
+from mimbus.utils import generate_token, prepare_db, session_scope, user_locks
 
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.filters import Command, Text
@@ -34,19 +43,22 @@ from aiogram.types import (
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
     CallbackQuery,
+    ChatMemberUpdated,
 )
 
 
 client = MimbusClient()
 
 bot = Bot(token=Config.BOT_TOKEN, parse_mode='HTML')
+sender = MessageSender(bot)
+broadcasts = BroadcastWorker(sender)
 router = Router()
 
 version = '0.0.1'
 
 logger = logging.getLogger('mimbus')
 
-guard_callbacks = {}  # fixme: temp storage required here!
+guard_sessions = GuardSessions()
 
 
 def get_keyboard(user: models.User) -> ReplyKeyboardMarkup:
@@ -65,7 +77,7 @@ def get_keyboard(user: models.User) -> ReplyKeyboardMarkup:
         )
 
 
-@router.message(Command('start'))
+@router.message(Command('start'), flags={'user_lock': True})
 async def start(message: Message, state: FSMContext, user: models.User):
     if not user.language:
         await language(message, state)
@@ -94,7 +106,7 @@ async def language(message: Message, state: FSMContext):
 
 
 # noinspection PyShadowingNames
-@router.message(AuthState.waiting_for_language, F.text.casefold() == 'english')
+@router.message(AuthState.waiting_for_language, F.text.casefold() == 'english', flags={'user_lock': True})
 async def english_language(message: Message, state: FSMContext, user: models.User, i18n: I18n):
     await state.clear()
     user.language = 'en'
@@ -103,7 +115,7 @@ async def english_language(message: Message, state: FSMContext, user: models.Use
 
 
 # noinspection PyShadowingNames
-@router.message(AuthState.waiting_for_language, F.text.casefold() == 'русский')
+@router.message(AuthState.waiting_for_language, F.text.casefold() == 'русский', flags={'user_lock': True})
 async def russian_language(message: Message, state: FSMContext, user: models.User, i18n: I18n):
     await state.clear()
     user.language = 'ru'
@@ -127,7 +139,7 @@ async def unknown_language(message: Message):
     )
 
 
-@router.message(Command('main'))
+@router.message(Command('main'), flags={'user_lock': True})
 async def main_menu(message: Message, state: FSMContext, user: models.User):
     if not user.refresh_token:
         await state.set_state(AuthState.waiting_for_steam_name)
@@ -162,7 +174,7 @@ async def main_menu(message: Message, state: FSMContext, user: models.User):
     )
 
 
-@router.message(Text(contains='📦'))
+@router.message(Text(contains='📦'), flags={'user_lock': True})
 async def assemble_modules(message: Message, user: models.User):
     await message.answer(
         gettext(
@@ -197,8 +209,8 @@ async def enter_exp_dungeon(message: Message, state: FSMContext):
     )
 
 
-@router.message(DungeonState.dungeon_id)
-async def handle_dungeon_id(message: Message, state: FSMContext, user: models.User):
+@router.message(DungeonState.dungeon_id, flags={'user_lock': True})
+async def handle_dungeon_id(message: Message, state: FSMContext, user: models.User, session: AsyncSession):
     dungeon_id = int(message.text.split(' ')[-1])
     await state.clear()
 
@@ -211,24 +223,17 @@ async def handle_dungeon_id(message: Message, state: FSMContext, user: models.Us
 
     await client.enter_exp_dungeon(uid=user.uid, auth_code=user.auth_token, dungeon_id=dungeon_id)
 
-    await message.answer(
-        gettext(
-            'Battle in progress, please wait...'
-        ),
-    )
-    await asyncio.sleep(random.uniform(5 * 60, 7 * 60))
-    await client.exit_exp_dungeon(uid=user.uid, auth_code=user.auth_token)
+    # the exit is a persisted job, so neither this handler nor a restart holds up the run
+    await dungeons.create(session, user.id, dungeon_id)
 
     await message.answer(
         gettext(
-            'Battle finished!'
+            'Battle in progress, please wait...'
         ),
     )
 
-    await main_menu(message, state, user)
-
 
-@router.message(AuthState.waiting_for_steam_name)
+@router.message(AuthState.waiting_for_steam_name, flags={'user_lock': True})
 async def steam_name(message: Message, state: FSMContext, user: models.User):
     user.steam_name = message.text
     await state.set_state(AuthState.waiting_for_steam_password)
@@ -255,8 +260,8 @@ async def steam_name(message: Message, state: FSMContext, user: models.User):
     )
 
 
-@router.message(AuthState.waiting_for_steam_password)
-async def steam_password(message: Message, state: FSMContext, user: models.User):
+@router.message(AuthState.waiting_for_steam_password, flags={'user_lock': True})
+async def steam_password(message: Message, state: FSMContext, user: models.User, session: AsyncSession):
     await message.delete()
     await message.answer(gettext('Authenticating...'))
 
@@ -272,7 +277,7 @@ async def steam_password(message: Message, state: FSMContext, user: models.User)
                 reply_markup=ReplyKeyboardRemove(),
             )
 
-            guard_callbacks[message.from_user.id] = resp.callback
+            await guard_sessions.put(session, message.from_user.id, resp.login_id)
             return
         else:
             user.refresh_token = resp.refresh_token
@@ -291,10 +296,10 @@ async def steam_password(message: Message, state: FSMContext, user: models.User)
     await main_menu(message, state, user)
 
 
-@router.message(AuthState.waiting_for_guard_code)
-async def steam_guard_code(message: Message, state: FSMContext, user: models.User):
-    callback = guard_callbacks.get(message.from_user.id)
-    if callback is None:
+@router.message(AuthState.waiting_for_guard_code, flags={'user_lock': True})
+async def steam_guard_code(message: Message, state: FSMContext, user: models.User, session: AsyncSession):
+    login_id = await guard_sessions.pop(session, message.from_user.id)
+    if login_id is None:
         await state.clear()
         await message.answer(
             gettext(
@@ -302,6 +307,7 @@ async def steam_guard_code(message: Message, state: FSMContext, user: models.Use
             ),
             reply_markup=ReplyKeyboardRemove(),
         )
+        return
 
     await message.answer(
         gettext(
@@ -309,10 +315,25 @@ async def steam_guard_code(message: Message, state: FSMContext, user: models.Use
         ),
     )
 
-    resp = await callback(message.text)
+    try:
+        resp = await token_service.continue_login(login_id, message.text)
+    except TokenServiceUnavailable:
+        # the login is kept by the service, so the same code can be sent again
+        await guard_sessions.put(session, message.from_user.id, login_id)
+        raise
+    except SteamException as e:
+        await state.clear()
+        await message.answer(
+            gettext(
+                'Unable to get the token. Wrong password? \n'
+                'Error: {error}'
+            ).format(error=e),
+            reply_markup=ReplyKeyboardRemove(),
+        )
+        return
 
     if resp.token is None:
-        guard_callbacks[message.from_user.id] = resp.callback
+        await guard_sessions.put(session, message.from_user.id, resp.login_id)
         await message.answer(
             gettext(
                 'Wrong Guard code. Please, try again: '
@@ -328,13 +349,13 @@ async def steam_guard_code(message: Message, state: FSMContext, user: models.Use
     await main_menu(message, state, user)
 
 
-@router.message(Command('relogin'))
+@router.message(Command('relogin'), flags={'user_lock': True})
 async def reload(message: Message, user: models.User):
     user.auth_token = None
     await message.answer(gettext('Done!'))
 
 
-@router.message(Command('logout'))
+@router.message(Command('logout'), flags={'user_lock': True})
 async def logout(message: Message, user: models.User):
     user.refresh_token = None
     user.auth_token = None
@@ -358,9 +379,10 @@ async def cancel(message: Message, state: FSMContext):
     )
 
 
-@router.message(Text(contains='🔁'))
-async def auto_assemble(message: Message, user: models.User):
+@router.message(Text(contains='🔁'), flags={'user_lock': True})
+async def auto_assemble(message: Message, user: models.User, session: AsyncSession):
     user.auto_assemble = not user.auto_assemble
+    worker.track(session, user)
     await message.answer(
         gettext(
             'Auto assemble has been {status}'
@@ -382,30 +404,50 @@ async def broadcast(message: Message, state: FSMContext, status: str):
 
 @router.message(AdminState.broadcast_message)
 async def broadcast_message(message: Message, state: FSMContext, session: AsyncSession):
-    query = select(models.User)
-    users = (await session.execute(query)).scalars().all()
-
-    for user in users:
-        await bot.send_message(
-            user.id,
-            message.text,
-        )
+    job = await broadcasts.create(session, message.text, message.from_user.id)
 
     await state.clear()
     await message.answer(
-        'Done!'
+        f'Broadcast #{job.id} started. Use /broadcasts to check the progress.'
+    )
+
+
+@router.message(Command('broadcasts'))
+async def broadcasts_status(message: Message, status: str):
+    if status not in ('creator', 'administrator'):
+        return
+
+    jobs = await broadcasts.progress()
+    if not jobs:
+        await message.answer('No broadcasts yet.')
+        return
+
+    await message.answer(
+        '\n'.join(
+            f'#{job.id} {"finished" if job.finished else "running"}: '
+            f'delivered {job.delivered}, failed {job.failed}'
+            for job in jobs
+        )
     )
 
 
+@router.chat_member()
+async def chat_member_updated(event: ChatMemberUpdated):
+    membership.on_chat_member(event)
+
+
 @router.callback_query(Text(contains='postpone'))
 async def postpone(callback: CallbackQuery):
-    async with session_scope() as session:
+    async with user_locks(callback.from_user.id), session_scope() as session:
         query = select(models.User).where(models.User.id == callback.from_user.id)
         user = (await session.execute(query)).scalar_one()
 
         with i18n.context(), i18n.use_locale(user.language):
             user.last_assembled_at = datetime.now()
             user.notification_sent = False
+            user.stamina = None
+            worker.track(session, user)
+            cache.invalidate_user(session, user.id)
 
             builder = InlineKeyboardBuilder()
             await callback.message.edit_text(
@@ -417,29 +459,61 @@ async def postpone(callback: CallbackQuery):
 
 
 async def main():
-    dp = Dispatcher()
+    fsm_storage = create_storage()
+    dp = Dispatcher(storage=fsm_storage)
     dp.include_router(router)
 
-    await proxy.storage.load()
-    proxy.storage.start()
+    if not proxy.storage.load_snapshot():
+        await proxy.storage.load()
+    proxy.storage.start(client.BASE_URL)
 
-    AutomationWorker(bot, auth, i18n).start()
+    await client.start()
+    sender.start()
 
     await prepare_db()
-    await dp.start_polling(bot)
+    if isinstance(fsm_storage, SQLStorage):
+        fsm_storage.start()
+
+    await membership.load()
+    worker.start()
+    refresher.start()
+    dungeons.start()
+    broadcasts.start()
+    metrics_runner = await metrics.start()
+    try:
+        if Config.BOT_MODE == 'webhook':
+            await run_webhook(dp, bot)
+        else:
+            # a webhook left from an earlier run in webhook mode makes getUpdates fail with 409 Conflict
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        await client.close()
+        await token_service.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 
 if __name__ == '__main__':
     i18n = I18n(path='locales', default_locale='en', domain='messages')
-    auth = AuthMiddleware()
-
-    router.message.middleware(SessionMiddleware())
-    router.message.middleware(UserMiddleware())
-    router.message.middleware(LanguageMiddleware(i18n))
-    router.message.middleware(ExceptionMiddleware(bot))
-    router.message.middleware(StatusMiddleware(bot))
-    router.message.middleware(AdminOnlyMiddleware())
-    router.message.middleware(auth)
+    auth = AuthMiddleware(client)
+    worker = AutomationWorker(sender, client, auth, i18n)
+    refresher = TokenRefresher(auth, worker)
+    dungeons = DungeonWorker(sender, client, auth, i18n, get_keyboard)
+    membership = StatusMiddleware(bot)
+
+    for middleware in (
+        UserLockMiddleware(),
+        SessionMiddleware(),
+        UserMiddleware(),
+        LanguageMiddleware(i18n),
+        ExceptionMiddleware(sender),
+        membership,
+        AdminOnlyMiddleware(),
+        auth,
+    ):
+        router.message.middleware(TimedMiddleware(middleware))
+    router.message.middleware(HandlerMetricsMiddleware())
 
     logging.basicConfig(
         level=logging.DEBUG,
@@ -1,37 +1,71 @@
 import asyncio
+import collections
+import contextlib
+import functools
+import heapq
 import logging
+import time
+import typing as tp
 from datetime import datetime, timedelta
 
+import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.sql import select
 
 from aiogram.utils.i18n import gettext, I18n
-from aiogram import Bot
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from mimbus import models
+from mimbus import cache, metrics, models, proxy
 from mimbus.client import MimbusClient
+from mimbus.lease import Leases
 from mimbus.middleware import AuthMiddleware
-from mimbus.utils import session_scope, format_exception
+from mimbus.sender import MessageSender
+from mimbus.utils import session_scope, format_exception, on_commit, release, user_locks
 from mimbus.config import Config
 
 
 class AutomationWorker:
+    NOTIFY = 'notify'
+    ASSEMBLE = 'assemble'
+
+    NOTIFY_BEFORE = timedelta(minutes=15)
+    ASSEMBLE_AFTER = timedelta(hours=8)
+
+    MODULE_COST = 20
+
     logger = logging.getLogger('mimbus.automation')
 
-    def __init__(self, bot: Bot, auth: AuthMiddleware, i18n: I18n):
-        self.bot = bot
-        self.client = MimbusClient()
+    def __init__(self, sender: MessageSender, client: MimbusClient, auth: AuthMiddleware, i18n: I18n):
+        self.sender = sender
+        self.client = client
         self.auth = auth
         self.i18n = i18n
+        self.leases = Leases(models.User)
+
+        self.semaphore = asyncio.Semaphore(Config.AUTOMATION_CONCURRENCY)
+        self.proxy_semaphores: dict[str | None, asyncio.Semaphore] = collections.defaultdict(
+            lambda: asyncio.Semaphore(Config.AUTOMATION_PROXY_CONCURRENCY)
+        )
+        self.last_tick: dict[str, int | float] = {}
+
+        self.queue: list[tuple[datetime, int, str, datetime]] = []
+        self.deadlines: dict[int, datetime] = {}
+        self.wakeup = asyncio.Event()
+        self.loaded_at = 0.
+        self.tasks: set[asyncio.Task] = set()
 
     async def process_user(self, user: models.User):
         self.logger.debug('Processing user %s', user.id)
-        user.last_assembled_at = datetime.now()
+        now = datetime.now()
+        expected = self.predict(user, now)
+        user.last_assembled_at = now
         user.notification_sent = False
+        # without a fresh reading from this run the user falls back to the fixed cadence
+        user.stamina = None
 
         if (datetime.now() - user.auth_token_created_at).total_seconds() > Config.AUTH_TOKEN_TTL:
             if not await self.auth.auth_with_refresh_token(user):
-                await self.bot.send_message(
+                await self.sender.send(
                     user.id,
                     gettext(
                         'Canceling auto-assembly.\n'
@@ -40,40 +74,198 @@ class AutomationWorker:
                 )
                 return
 
-        data = await self.client.load_all(uid=user.uid, auth_code=user.auth_token)
+        # the purchase is sized from this, so it must not come from the response cache
+        data = await self.client.reload_all(user.uid, user.auth_token)
         stamina = data.updated.user_info.stamina
+        self.learn_cap(user, stamina, expected)
 
-        modules_count = stamina // 20
+        modules_count = stamina // self.MODULE_COST
         if modules_count > 0:
             await self.client.purchase_enkephalin_module(uid=user.uid, auth_code=user.auth_token, num=modules_count)
 
-        await self.bot.send_message(
+        self.observe(user, stamina - modules_count * self.MODULE_COST, data.updated.user_info.last_stamina_recover)
+
+        await self.sender.send(
             user.id,
             gettext(
                 '{num} modules have been assembled. '
             ).format(num=modules_count)
         )
 
-    async def run_once(self):
-        async with session_scope() as session:
-            query = select(models.User).where(
-                models.User.auto_assemble.is_(True),
-                models.User.last_assembled_at < datetime.now() - timedelta(hours=7, minutes=45),
-                models.User.last_assembled_at > datetime.now() - timedelta(hours=8),
-                models.User.notification_sent.is_(False),
+    @staticmethod
+    def observe(user: models.User, stamina: int, last_stamina_recover: str):
+        now = datetime.now()
+        try:
+            recovered_at = datetime.fromisoformat(last_stamina_recover).replace(tzinfo=None)
+        except ValueError:
+            recovered_at = now
+
+        # the game clock may be in another timezone; the regen timer is never further off than one interval
+        user.stamina = stamina
+        user.stamina_recovered_at = min(now, max(recovered_at, now - timedelta(seconds=Config.STAMINA_RECOVER_INTERVAL)))
+
+    @staticmethod
+    def predict(user: models.User, now: datetime) -> int | None:
+        # what the last reading grows to by now if nothing stops it
+        if user.stamina is None or user.stamina_recovered_at is None:
+            return None
+
+        return user.stamina + int((now - user.stamina_recovered_at).total_seconds() // Config.STAMINA_RECOVER_INTERVAL)
+
+    @staticmethod
+    def learn_cap(user: models.User, stamina: int, expected: int | None):
+        if expected is not None and stamina < expected:
+            # regeneration stopped short of the prediction, so this is where it stops; if the stamina was spent
+            # in the game instead, the next reading is above the estimate and raises it again
+            user.stamina_cap = stamina
+        elif stamina > (user.stamina_cap or Config.STAMINA_CAP):
+            user.stamina_cap = stamina
+
+    @classmethod
+    def due_at(
+            cls,
+            last_assembled_at: datetime | None,
+            stamina: int | None,
+            stamina_recovered_at: datetime | None,
+            stamina_cap: int | None,
+    ) -> datetime:
+        last_assembled_at = last_assembled_at or datetime.fromtimestamp(0)
+        fallback = last_assembled_at + cls.ASSEMBLE_AFTER
+        if stamina is None or stamina_recovered_at is None:
+            return fallback
+
+        # wait until a single call buys the most modules the cap allows, but never retry a user too often,
+        # and never wait longer than the fixed cadence would have, in case the cap is overestimated
+        target = (stamina_cap or Config.STAMINA_CAP) // cls.MODULE_COST * cls.MODULE_COST
+        full_at = stamina_recovered_at + max(0, target - stamina) * timedelta(seconds=Config.STAMINA_RECOVER_INTERVAL)
+        return min(max(full_at, last_assembled_at + timedelta(seconds=Config.AUTOMATION_MIN_INTERVAL)), fallback)
+
+    @classmethod
+    def user_due_at(cls, user: models.User) -> datetime:
+        return cls.due_at(user.last_assembled_at, user.stamina, user.stamina_recovered_at, user.stamina_cap)
+
+    @contextlib.asynccontextmanager
+    async def limit(self, uid: int | None = None):
+        # per-proxy slot first, so users queued behind one proxy do not hold global slots
+        async with self.proxy_semaphores[proxy.storage.get(uid or 1)], self.semaphore:
+            yield
+
+    def schedule(self, user_id: int, due: datetime, notification_sent: bool = False):
+        self.deadlines[user_id] = due
+
+        if not notification_sent:
+            heapq.heappush(self.queue, (due - self.NOTIFY_BEFORE, user_id, self.NOTIFY, due))
+        heapq.heappush(self.queue, (due, user_id, self.ASSEMBLE, due))
+
+        self.wakeup.set()
+
+    def unschedule(self, user_id: int):
+        # heap entries are dropped lazily once they no longer match `deadlines`
+        self.deadlines.pop(user_id, None)
+
+    def track(self, session: AsyncSession, user: models.User):
+        if user.auto_assemble:
+            callback = functools.partial(self.schedule, user.id, self.user_due_at(user), user.notification_sent)
+        else:
+            callback = functools.partial(self.unschedule, user.id)
+
+        on_commit(session, callback)
+
+    def reschedule(self, user: models.User | None, user_id: int):
+        if user is None or not user.auto_assemble:
+            self.unschedule(user_id)
+        elif self.deadlines.get(user_id) != (due := self.user_due_at(user)):
+            self.schedule(user.id, due, user.notification_sent)
+
+    async def iter_scheduled(self) -> tp.AsyncIterator[tp.Sequence[sqlalchemy.Row]]:
+        key = None
+        while True:
+            async with session_scope(autocommit=False) as session:
+                query = select(
+                    models.User.id,
+                    models.User.last_assembled_at,
+                    models.User.notification_sent,
+                    models.User.stamina,
+                    models.User.stamina_recovered_at,
+                    models.User.stamina_cap,
+                ).where(
+                    models.User.auto_assemble.is_(True),
+                ).order_by(
+                    models.User.last_assembled_at,
+                    models.User.id,
+                ).limit(
+                    Config.AUTOMATION_PAGE_SIZE,
+                )
+
+                if key is not None:
+                    query = query.where(sqlalchemy.tuple_(models.User.last_assembled_at, models.User.id) > key)
+
+                rows = (await session.execute(query)).all()
+
+            if not rows:
+                return
+
+            yield rows
+
+            key = sqlalchemy.tuple_(rows[-1].last_assembled_at, rows[-1].id)
+
+    async def load(self):
+        self.queue = []
+        self.deadlines = {}
+
+        async for rows in self.iter_scheduled():
+            for user_id, last_assembled_at, notification_sent, stamina, stamina_recovered_at, stamina_cap in rows:
+                due = self.due_at(last_assembled_at, stamina, stamina_recovered_at, stamina_cap)
+                self.schedule(user_id, due, notification_sent)
+
+        self.loaded_at = time.monotonic()
+        self.logger.debug('Scheduled %s users', len(self.deadlines))
+
+    def pop_due(self, now: datetime) -> list[tuple[int, str]]:
+        jobs = []
+        while self.queue and self.queue[0][0] <= now:
+            _, user_id, kind, due = heapq.heappop(self.queue)
+            if self.deadlines.get(user_id) == due:
+                jobs.append((user_id, kind))
+
+        return jobs
+
+    def next_timeout(self) -> float:
+        timeout = self.loaded_at + Config.AUTOMATION_RESYNC_INTERVAL - time.monotonic()
+        if self.queue:
+            timeout = min(timeout, (self.queue[0][0] - datetime.now()).total_seconds())
+
+        return max(timeout, 0)
+
+    async def notify_user(self, user_id: int) -> bool:
+        async with self.semaphore, user_locks(user_id), session_scope() as session:
+            user = await session.get(models.User, user_id)
+
+            now = datetime.now()
+            if (
+                user is None or
+                not user.auto_assemble or
+                user.notification_sent or
+                not now < self.user_due_at(user) <= now + self.NOTIFY_BEFORE
+            ):
+                self.reschedule(user, user_id)
+                return True
+
+            await release(session)
+            metrics.automation_lag_seconds.observe(
+                (now - self.user_due_at(user) + self.NOTIFY_BEFORE).total_seconds(), self.NOTIFY,
             )
 
-            users_to_notify = (await session.execute(query)).scalars().all()
-            for user in users_to_notify:
-                with self.i18n.context(), self.i18n.use_locale(user.language):
-                    self.logger.debug('Sending notification to user %s', user.id)
+            with self.i18n.context(), self.i18n.use_locale(user.language):
+                self.logger.debug('Sending notification to user %s', user.id)
 
-                    builder = InlineKeyboardBuilder()
-                    builder.button(
-                        text=gettext('Skip for 8 hours'), callback_data='postpone'
-                    )
+                builder = InlineKeyboardBuilder()
+                builder.button(
+                    text=gettext('Skip for 8 hours'), callback_data='postpone'
+                )
 
-                    await self.bot.send_message(
+                try:
+                    await self.sender.send(
                         user.id,
                         gettext(
                             'The modules will be assembled in 15 minutes. '
@@ -81,32 +273,152 @@ class AutomationWorker:
                         ),
                         reply_markup=builder.as_markup(),
                     )
-                    user.notification_sent = True
+                except Exception as e:
+                    self.logger.error('Unable to notify user %s. Error: %s', user.id, format_exception(e))
+                    return False
 
-            query = select(models.User).where(
-                models.User.auto_assemble.is_(True),
-                models.User.last_assembled_at < datetime.now() - timedelta(hours=8),
-            )
-            users_to_process = (await session.execute(query)).scalars().all()
-            for user in users_to_process:
-                with self.i18n.context(), self.i18n.use_locale(user.language):
-                    try:
-                        await self.process_user(user)
-                    except Exception as e:
-                        self.logger.error('Unable to process user %s. Error: %s', user.id, format_exception(e, with_traceback=True))
-
-                        await self.bot.send_message(
+                user.notification_sent = True
+                cache.invalidate_user(session, user.id)
+                return True
+
+    def is_due(self, user: models.User | None) -> bool:
+        return (
+            user is not None and
+            user.auto_assemble and
+            self.user_due_at(user) <= datetime.now()
+        )
+
+    async def assemble_user(self, user_id: int) -> bool:
+        async with session_scope() as session:
+            user = await session.get(models.User, user_id)
+            if not self.is_due(user):
+                self.reschedule(user, user_id)
+                return True
+
+            uid = user.uid
+
+        # the user lock serializes processing with the user's own handlers, see UserLockMiddleware
+        async with self.limit(uid), user_locks(user_id), session_scope() as session:
+            user = await session.get(models.User, user_id)
+            if not self.is_due(user):
+                self.reschedule(user, user_id)
+                return True
+
+            await release(session)
+            metrics.automation_lag_seconds.observe((datetime.now() - self.user_due_at(user)).total_seconds(), self.ASSEMBLE)
+
+            with self.i18n.context(), self.i18n.use_locale(user.language):
+                try:
+                    await self.process_user(user)
+                    return True
+                except Exception as e:
+                    self.logger.error('Unable to process user %s. Error: %s', user.id, format_exception(e, with_traceback=True))
+
+                    with contextlib.suppress(Exception):
+                        await self.sender.send(
                             user.id,
                             gettext(
                                 'Failed to assemble modules. Contact admin.'
                             ),
                         )
+                    return False
+                finally:
+                    self.track(session, user)
+                    cache.invalidate_user(session, user.id)
+
+    async def claim(self, jobs: list[tuple[int, str]]) -> list[tuple[int, str]]:
+        try:
+            claimed = await self.leases.claim({user_id for user_id, _ in jobs})
+        except Exception as e:
+            self.logger.error('Unable to claim %s users. Error: %s', len(jobs), format_exception(e))
+            claimed = set()
+
+        # users leased by another worker are looked at again once that lease could have run out
+        retry_at = datetime.now() + self.leases.ttl
+        for user_id, kind in jobs:
+            if user_id not in claimed and (due := self.deadlines.get(user_id)) is not None:
+                heapq.heappush(self.queue, (retry_at, user_id, kind, due))
+
+        if len(claimed) < len(jobs):
+            self.wakeup.set()
+
+        return [(user_id, kind) for user_id, kind in jobs if user_id in claimed]
+
+    async def run_jobs(self, jobs: list[tuple[int, str]]):
+        jobs = await self.claim(jobs)
+        if not jobs:
+            return
+
+        try:
+            await self.process_jobs(jobs)
+        finally:
+            try:
+                await self.leases.release({user_id for user_id, _ in jobs})
+            except Exception as e:
+                # the leases simply run out
+                self.logger.error('Unable to release %s users. Error: %s', len(jobs), format_exception(e))
+
+    async def run_job(self, user_id: int, kind: str) -> bool:
+        result = False
+        try:
+            result = await (self.notify_user(user_id) if kind == self.NOTIFY else self.assemble_user(user_id))
+            return result
+        finally:
+            metrics.automation_backlog.dec()
+            metrics.automation_jobs.inc(kind, 'ok' if result is True else 'failed')
+
+    async def process_jobs(self, jobs: list[tuple[int, str]]):
+        started_at = time.monotonic()
+
+        metrics.automation_backlog.inc(amount=len(jobs))
+        results = await asyncio.gather(
+            *(self.run_job(user_id, kind) for user_id, kind in jobs),
+            return_exceptions=True,
+        )
+
+        for result in results:
+            if isinstance(result, Exception):
+                self.logger.error('Automation task failed. Error: %s', format_exception(result, with_traceback=True))
+
+        elapsed = time.monotonic() - started_at
+        metrics.automation_batch_seconds.observe(elapsed)
+
+        notified = sum(kind == self.NOTIFY for _, kind in jobs)
+        failed = sum(result is not True for result in results)
+        self.last_tick = {
+            'notified': notified,
+            'processed': len(jobs) - notified,
+            'failed': failed,
+            'elapsed': elapsed,
+        }
+
+        self.logger.info(
+            'Batch finished: %s notified, %s processed, %s failed in %.2fs (%.2f users/s)',
+            notified, len(jobs) - notified, failed, elapsed, len(jobs) / max(elapsed, 1e-9),
+        )
 
     async def loop(self):
         while True:
-            await self.run_once()
-            await asyncio.sleep(60)
+            try:
+                await self.load()
+            except Exception as e:
+                self.logger.error('Unable to load schedule. Error: %s', format_exception(e, with_traceback=True))
+                await asyncio.sleep(60)
+                continue
+
+            while time.monotonic() - self.loaded_at < Config.AUTOMATION_RESYNC_INTERVAL:
+                if jobs := self.pop_due(datetime.now()):
+                    task = asyncio.create_task(self.run_jobs(jobs))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                    continue
+
+                self.wakeup.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.wakeup.wait(), self.next_timeout())
 
     def start(self):
         self.logger.debug('Starting automation worker')
+        self.leases.start()
+        metrics.automation_scheduled.set_function(lambda: len(self.deadlines))
         asyncio.create_task(self.loop())
@@ -0,0 +1,133 @@
+import asyncio
+import functools
+import logging
+import typing as tp
+from datetime import datetime
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql import select, update
+
+from mimbus import models
+from mimbus.config import Config
+from mimbus.lease import Leases
+from mimbus.sender import MessageSender, Priority
+from mimbus.utils import session_scope, format_exception, on_commit
+
+
+class BroadcastWorker:
+    logger = logging.getLogger('mimbus.broadcast')
+
+    def __init__(self, sender: MessageSender):
+        self.sender = sender
+        self.leases = Leases(models.Broadcast)
+        self.tasks: dict[int, asyncio.Task] = {}
+
+    async def create(self, session: AsyncSession, text: str, created_by: int) -> models.Broadcast:
+        broadcast = models.Broadcast(text=text, created_by=created_by)
+        session.add(broadcast)
+        await session.flush()
+
+        on_commit(session, functools.partial(self.launch, broadcast.id))
+        return broadcast
+
+    def launch(self, broadcast_id: int):
+        if broadcast_id in self.tasks:
+            return
+
+        task = self.tasks[broadcast_id] = asyncio.create_task(self.run(broadcast_id))
+        task.add_done_callback(lambda _: self.tasks.pop(broadcast_id, None))
+
+    async def next_page(self, last_user_id: int) -> tp.Sequence[int]:
+        query = select(models.User.id).where(
+            models.User.id > last_user_id,
+        ).order_by(
+            models.User.id,
+        ).limit(
+            Config.BROADCAST_PAGE_SIZE,
+        )
+
+        async with session_scope(autocommit=False) as session:
+            return (await session.execute(query)).scalars().all()
+
+    async def checkpoint(self, broadcast_id: int, **values):
+        async with session_scope() as session:
+            await session.execute(update(models.Broadcast).where(models.Broadcast.id == broadcast_id).values(**values))
+
+    async def run(self, broadcast_id: int):
+        # with several processes only the one holding the lease sends, the others pick it up if it dies
+        try:
+            if not await self.leases.claim([broadcast_id]):
+                return
+        except Exception as e:
+            self.logger.error('Unable to claim broadcast %s. Error: %s', broadcast_id, format_exception(e))
+            return
+
+        try:
+            await self.deliver(broadcast_id)
+        finally:
+            try:
+                await self.leases.release([broadcast_id])
+            except Exception as e:
+                self.logger.error('Unable to release broadcast %s. Error: %s', broadcast_id, format_exception(e))
+
+    async def deliver(self, broadcast_id: int):
+        async with session_scope(autocommit=False) as session:
+            broadcast = await session.get(models.Broadcast, broadcast_id)
+
+        if broadcast is None or broadcast.finished:
+            return
+
+        self.logger.info('Running broadcast %s from user %s', broadcast_id, broadcast.last_user_id)
+        last_user_id = broadcast.last_user_id
+
+        try:
+            while user_ids := await self.next_page(last_user_id):
+                results = await asyncio.gather(
+                    *(self.sender.send(user_id, broadcast.text, priority=Priority.BROADCAST) for user_id in user_ids),
+                    return_exceptions=True,
+                )
+                failed = sum(isinstance(result, Exception) for result in results)
+                last_user_id = user_ids[-1]
+
+                # checkpoint after every page, so a restart resends at most one page
+                await self.checkpoint(
+                    broadcast_id,
+                    last_user_id=last_user_id,
+                    delivered=models.Broadcast.delivered + len(results) - failed,
+                    failed=models.Broadcast.failed + failed,
+                )
+
+            await self.checkpoint(broadcast_id, finished=True, finished_at=datetime.now())
+            self.logger.info('Broadcast %s finished', broadcast_id)
+        except Exception as e:
+            self.logger.error('Broadcast %s failed. Error: %s', broadcast_id, format_exception(e, with_traceback=True))
+
+    async def progress(self, limit: int = 5) -> list[models.Broadcast]:
+        async with session_scope(autocommit=False) as session:
+            query = select(models.Broadcast).order_by(models.Broadcast.id.desc()).limit(limit)
+            return list((await session.execute(query)).scalars().all())
+
+    async def resume(self):
+        async with session_scope(autocommit=False) as session:
+            query = select(models.Broadcast.id).where(models.Broadcast.finished.is_(False))
+            broadcast_ids = (await session.execute(query)).scalars().all()
+
+        for broadcast_id in broadcast_ids:
+            if broadcast_id not in self.tasks:
+                self.logger.debug('Resuming broadcast %s', broadcast_id)
+                self.launch(broadcast_id)
+
+    async def loop(self):
+        # broadcasts left by a process that died are taken over once their lease runs out
+        while True:
+            try:
+                await self.resume()
+            except Exception as e:
+                self.logger.error('Unable to resume broadcasts. Error: %s', format_exception(e))
+
+            await asyncio.sleep(self.leases.ttl.total_seconds())
+
+    def start(self):
+        self.logger.debug('Starting broadcast worker')
+        self.leases.start()
+        asyncio.create_task(self.loop())
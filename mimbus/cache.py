@@ -0,0 +1,79 @@
+import collections
+import functools
+import time
+import typing as tp
+
+import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
+
+from mimbus import models
+from mimbus.config import Config
+from mimbus.utils import on_commit
+
+K = tp.TypeVar('K')
+V = tp.TypeVar('V')
+
+
+class TTLCache(tp.Generic[K, V]):
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: collections.OrderedDict[K, tuple[float, V]] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def get(self, key: K, default: V | None = None) -> V | None:
+        if (item := self.data.get(key)) is None:
+            return default
+
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self.data[key]
+            return default
+
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key: K, value: V, ttl: float | None = None):
+        self.data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.data.move_to_end(key)
+
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def keys(self) -> list[K]:
+        now = time.monotonic()
+        return [key for key, (expires_at, _) in self.data.items() if expires_at >= now]
+
+    def pop(self, key: K, default: V | None = None) -> V | None:
+        item = self.data.pop(key, None)
+        return default if item is None else item[1]
+
+
+users: TTLCache[int, dict[str, tp.Any]] = TTLCache(Config.USER_CACHE_SIZE, Config.USER_CACHE_TTL)
+
+
+def snapshot_user(user: models.User) -> dict[str, tp.Any] | None:
+    state = sqlalchemy.inspect(user)
+
+    # rows with unloaded attributes (e.g. server defaults right after insert) are not cached,
+    # since restoring them would leave expired attributes that need IO to load
+    values = state.dict
+    if any(attr.key not in values for attr in state.mapper.column_attrs):
+        return None
+
+    return {attr.key: values[attr.key] for attr in state.mapper.column_attrs}
+
+
+def restore_user(session: AsyncSession, values: dict[str, tp.Any]) -> models.User:
+    user = models.User(**values)
+    make_transient_to_detached(user)
+    session.add(user)
+    return user
+
+
+def invalidate_user(session: AsyncSession, user_id: int):
+    users.pop(user_id)
+    on_commit(session, functools.partial(users.pop, user_id))
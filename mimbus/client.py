@@ -6,8 +6,12 @@ import base64
 import random
 import functools
 import logging
+import orjson
+import time
+import typing as tp
 
-from mimbus import structures, proxy, exceptions, utils
+from mimbus import cache, structures, proxy, exceptions, metrics, utils
+from mimbus.config import Config
 
 
 def with_proxy(func):
@@ -18,20 +22,79 @@ def with_proxy(func):
 
         self.logger.debug('Using proxy: %s for uid %s', proxy_host or 'no proxy', uid)
 
+        started_at = time.monotonic()
         try:
-            return await func(self, *args, **kwargs, proxy_host=proxy_host)
+            result = await func(self, *args, **kwargs, proxy_host=proxy_host)
         except (
                 asyncio.TimeoutError,
                 aiohttp.client_exceptions.ServerDisconnectedError,
                 aiohttp.client_exceptions.ClientConnectorError
         ):
-            proxy.storage.remove(uid)
+            proxy.storage.record_failure(proxy_host)
             self.logger.debug('Proxy %s is not working for uid %s', proxy_host, uid)
             raise exceptions.RetryException('Failed to connect to the server.')
+        except exceptions.APIException:
+            proxy.storage.record_success(proxy_host, time.monotonic() - started_at)
+            raise
+
+        proxy.storage.record_success(proxy_host, time.monotonic() - started_at)
+        return result
 
     return wrapper
 
 
+class Endpoint(tp.NamedTuple):
+    path: str
+    response: type[structures.MimbusBaseResponse]
+    parameters: tp.Callable[..., dict] = dict
+    mutates: bool = False
+
+
+ENDPOINTS: dict[str, Endpoint] = {}
+
+
+def endpoint(
+        path: str,
+        response: type[structures.MimbusBaseResponse],
+        parameters: tp.Callable[..., dict] = dict,
+        mutates: bool = False,
+):
+    spec = ENDPOINTS[path] = Endpoint(path, response, parameters, mutates)
+
+    async def method(self: 'MimbusClient', uid: int, auth_code: str, proxy_host: str | None = None, **kwargs):
+        try:
+            return await self.request(spec, self.envelope(uid, auth_code), spec.parameters(**kwargs), proxy_host)
+        finally:
+            # even a failed call may have changed the account server-side
+            if spec.mutates:
+                self.invalidate(uid)
+
+    # named after the endpoint before `retry` reads it, so retry metrics tell endpoints apart
+    method.__name__ = path.rsplit('/', 1)[-1]
+    method.__qualname__ = f'MimbusClient.{method.__name__}'
+
+    method = utils.retry(exceptions=(exceptions.RetryException,))(with_proxy(method))
+    method.endpoint = spec
+    return method
+
+
+SIGN_IN = ENDPOINTS['/login/SignInAsSteam'] = Endpoint('/login/SignInAsSteam', structures.SteamLoginResponse)
+
+EXIT_EXP_DUNGEON_PARAMETERS = {
+    'formationId': 0,
+    'isWin': 1,
+    'supportCharacterId': -1,
+    'supportParticipate': False,
+    'battlePassParameters': {
+        'enemyKillCount': 10,
+        'abnormalityKillCount': 0,
+        'isUsedDailyChar': True,
+        'isUsedSeasonEgo': False,
+        'isUsedSeasonAnnouncer': False
+    },
+}
+
+
 class MimbusClient:
     BASE_URL = base64.b64decode('aHR0cHM6Ly93d3cubGltYnVzY29tcGFueWFwaS0yLmNvbQ==').decode('utf-8')  # Mimbus url
 
@@ -43,179 +106,155 @@ class MimbusClient:
         'X-Unity-Version': '2021.3.0f1',
     }
 
+    TIMEOUT = 10
+
     VERSION = '1.3.0'
     DATA_VERSION = 26
 
     logger = logging.getLogger('mimbus.client')
 
+    def __init__(self):
+        self._session: aiohttp.ClientSession | None = None
+
+        # LoadUserDataAll responses by uid, see `load_all`
+        self.responses: cache.TTLCache[int, structures.LoadAllResponse] = cache.TTLCache(
+            Config.LOAD_ALL_CACHE_SIZE, Config.LOAD_ALL_CACHE_TTL,
+        )
+        self.loading: dict[int, object] = {}
+        self.flights = utils.SingleFlight()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            raise RuntimeError('MimbusClient is not started')
+
+        return self._session
+
+    async def start(self):
+        if self._session is not None and not self._session.closed:
+            return
+
+        self.logger.debug('Starting mimbus client')
+
+        # aiohttp keys pooled connections by (host, port, ssl, proxy), and every request goes to BASE_URL,
+        # so `limit_per_host` is effectively a per-proxy cap while `limit` bounds the whole pool.
+        connector = aiohttp.TCPConnector(
+            limit=Config.HTTP_POOL_LIMIT,
+            limit_per_host=Config.HTTP_POOL_LIMIT_PER_PROXY,
+            keepalive_timeout=Config.HTTP_KEEPALIVE_TIMEOUT,
+        )
+        self._session = aiohttp.ClientSession(
+            headers=self.HEADERS,
+            timeout=aiohttp.ClientTimeout(total=self.TIMEOUT),
+            connector=connector,
+        )
+
+    async def close(self):
+        if self._session is None:
+            return
+
+        self.logger.debug('Closing mimbus client')
+        await self._session.close()
+        self._session = None
+
     @staticmethod
     def check_for_status(data: dict) -> None:
         if data.get('state') != 'ok':
             raise exceptions.APIException(f'Failed to load data. Status code: {data.get("state")}')
 
-    @utils.retry(exceptions=(exceptions.RetryException,))
-    @with_proxy
-    async def sign_in(self, steam_token: str, proxy_host: str | None = None, uid: int | None = None) -> structures.SteamLoginResponse:
-        _ = uid
-        timeout = aiohttp.ClientTimeout(total=10)
-
-        async with aiohttp.ClientSession(headers=self.HEADERS, timeout=timeout) as session:
-            async with session.post(
-                f'{self.BASE_URL}/login/SignInAsSteam',
-                json={
-                    'userAuth': {
-                        'uid': 0,
-                        'dbid': 0,
-                        'authCode': '',
-                        'version': self.VERSION,
-                        'synchronousDataVersion': self.DATA_VERSION
-                    },
-                    'parameters': {
-                        'steamToken': steam_token,
-                        'version': self.VERSION,
-                        'deviceModel': 'Desktop'
-                    },
-                },
-                proxy=proxy_host,
-            ) as response:
-                data = await response.json()
-                self.check_for_status(data)
-                return structures.SteamLoginResponse.parse_obj(data)
+    @classmethod
+    @functools.lru_cache(maxsize=4096)
+    def envelope(cls, uid: int, auth_code: str) -> bytes:
+        return orjson.dumps({
+            'uid': uid,
+            'dbid': 0,
+            'authCode': auth_code,
+            'version': cls.VERSION,
+            'synchronousDataVersion': cls.DATA_VERSION,
+        })
 
-    @utils.retry(exceptions=(exceptions.RetryException,))
-    @with_proxy
-    async def load_all(self, uid: int, auth_code: str, proxy_host: str | None = None) -> structures.LoadAllResponse:
-        timeout = aiohttp.ClientTimeout(total=10)
-
-        async with aiohttp.ClientSession(headers=self.HEADERS, timeout=timeout) as session:
-            async with session.post(
-                f'{self.BASE_URL}/api/LoadUserDataAll',
-                json={
-                    'userAuth': {
-                        'uid': uid,
-                        'dbid': 0,
-                        'authCode': auth_code,
-                        'version': self.VERSION,
-                        'synchronousDataVersion': self.DATA_VERSION
-                    },
-                    'parameters': {},
-                },
-                proxy=proxy_host,
-            ) as response:
-                data = await response.json()
-                self.check_for_status(data)
-                return structures.LoadAllResponse.parse_obj(data)
+    async def request(self, endpoint: Endpoint, envelope: bytes, parameters: dict, proxy_host: str | None = None):
+        body = b'{"userAuth":%b,"parameters":%b}' % (envelope, orjson.dumps(parameters))
 
-    @utils.retry(exceptions=(exceptions.RetryException,))
-    @with_proxy
-    async def purchase_enkephalin_module(self, uid: int, auth_code: str, num: int, proxy_host: str | None = None) -> structures.MimbusBaseResponse:
-        timeout = aiohttp.ClientTimeout(total=10)
-
-        async with aiohttp.ClientSession(headers=self.HEADERS, timeout=timeout) as session:
-            async with session.post(
-                f'{self.BASE_URL}/api/PurchaseEnkephalinModule',
-                json={
-                    'userAuth': {
-                        'uid': uid,
-                        'dbid': 0,
-                        'authCode': auth_code,
-                        'version': self.VERSION,
-                        'synchronousDataVersion': self.DATA_VERSION
-                    },
-                    'parameters': {
-                        'num': num
-                    },
-                },
-                proxy=proxy_host,
-            ) as response:
-                data = await response.json()
-                self.check_for_status(data)
-                return structures.MimbusBaseResponse.parse_obj(data)
+        labels = (endpoint.path, proxy_host or 'direct')
+        if (timeout := utils.remaining(self.TIMEOUT)) <= 0:
+            metrics.client_requests.inc(*labels, 'deadline')
+            raise exceptions.RetryException('Request deadline exceeded.')
 
-    @utils.retry(exceptions=(exceptions.RetryException,))
-    @with_proxy
-    async def enter_exp_dungeon(self, uid: int, dungeon_id: int, auth_code: str, proxy_host: str | None = None) -> structures.MimbusBaseResponse:
-        timeout = aiohttp.ClientTimeout(total=10)
-
-        async with aiohttp.ClientSession(headers=self.HEADERS, timeout=timeout) as session:
-            async with session.post(
-                f'{self.BASE_URL}/api/EnterExpDungeon',
-                json={
-                    'userAuth': {
-                        'uid': uid,
-                        'dbid': 0,
-                        'authCode': auth_code,
-                        'version': self.VERSION,
-                        'synchronousDataVersion': self.DATA_VERSION
-                    },
-                    'parameters': {
-                        'dungeonid': dungeon_id
-                    },
-                },
+        code = 'error'
+        started_at = time.monotonic()
+        try:
+            async with self.session.post(
+                f'{self.BASE_URL}{endpoint.path}',
+                data=body,
                 proxy=proxy_host,
+                timeout=aiohttp.ClientTimeout(total=timeout),
             ) as response:
-                data = await response.json()
-                self.check_for_status(data)
-                return structures.MimbusBaseResponse.parse_obj(data)
+                code = str(response.status)
+                data = orjson.loads(await response.read())
 
-    @utils.retry(exceptions=(exceptions.RetryException,))
-    @with_proxy
-    async def exit_exp_dungeon(self, uid: int, auth_code: str, proxy_host: str | None = None) -> structures.MimbusBaseResponse:
-        timeout = aiohttp.ClientTimeout(total=10)
-
-        async with aiohttp.ClientSession(headers=self.HEADERS, timeout=timeout) as session:
-            async with session.post(
-                f'{self.BASE_URL}/api/ExitExpDungeon',
-                json={
-                    'userAuth': {
-                        'uid': uid,
-                        'dbid': 0,
-                        'authCode': auth_code,
-                        'version': self.VERSION,
-                        'synchronousDataVersion': self.DATA_VERSION
-                    },
-                    'parameters': {
-                        'formationId': 0,
-                        'isWin': 1,
-                        'supportCharacterId': -1,
-                        'supportParticipate': False,
-                        'battlePassParameters': {
-                            'enemyKillCount': 10,
-                            'abnormalityKillCount': 0,
-                            'isUsedDailyChar': True,
-                            'isUsedSeasonEgo': False,
-                            'isUsedSeasonAnnouncer': False
-                        },
-                    },
-                },
-                proxy=proxy_host,
-            ) as response:
-                data = await response.json()
-                self.check_for_status(data)
-                return structures.MimbusBaseResponse.parse_obj(data)
+            # the game reports its own errors with a 200 and a state other than ok
+            if response.status == 200:
+                code = str(data.get('state'))
+        except asyncio.TimeoutError:
+            code = 'timeout'
+            raise
+        except aiohttp.ClientError:
+            code = 'connection'
+            raise
+        finally:
+            metrics.client_request_seconds.observe(time.monotonic() - started_at, *labels)
+            metrics.client_requests.inc(*labels, code)
+
+        self.check_for_status(data)
+        return endpoint.response.parse_obj(data)
 
     @utils.retry(exceptions=(exceptions.RetryException,))
     @with_proxy
-    async def unseal_mails(self, uid: int, mail_id: int, auth_code: str, proxy_host: str | None = None) -> structures.MimbusBaseResponse:
-        timeout = aiohttp.ClientTimeout(total=10)
-
-        async with aiohttp.ClientSession(headers=self.HEADERS, timeout=timeout) as session:
-            async with session.post(
-                f'{self.BASE_URL}/api/UnsealMails',
-                json={
-                    'userAuth': {
-                        'uid': uid,
-                        'dbid': 0,
-                        'authCode': auth_code,
-                        'version': self.VERSION,
-                        'synchronousDataVersion': self.DATA_VERSION
-                    },
-                    'parameters': {
-                        'mailIds': [mail_id],
-                    },
-                },
-                proxy=proxy_host,
-            ) as response:
-                data = await response.json()
-                self.check_for_status(data)
-                return structures.MimbusBaseResponse.parse_obj(data)
+    async def sign_in(self, steam_token: str, proxy_host: str | None = None, uid: int | None = None) -> structures.SteamLoginResponse:
+        _ = uid
+        return await self.request(
+            SIGN_IN,
+            self.envelope(0, ''),
+            {'steamToken': steam_token, 'version': self.VERSION, 'deviceModel': 'Desktop'},
+            proxy_host,
+        )
+
+    async def load_all(self, uid: int, auth_code: str) -> structures.LoadAllResponse:
+        if (data := self.responses.get(uid)) is not None:
+            return data
+
+        return await self.flights.do(uid, functools.partial(self.reload_all, uid, auth_code))
+
+    async def reload_all(self, uid: int, auth_code: str) -> structures.LoadAllResponse:
+        token = self.loading[uid] = object()
+        try:
+            data = await self.fetch_all(uid=uid, auth_code=auth_code)
+
+            # a mutating call that finished meanwhile has made this response stale
+            if self.loading.get(uid) is token:
+                self.responses.set(uid, data)
+
+            return data
+        finally:
+            if self.loading.get(uid) is token:
+                del self.loading[uid]
+
+    def invalidate(self, uid: int):
+        self.responses.pop(uid)
+        self.loading.pop(uid, None)
+        self.flights.forget(uid)
+
+    fetch_all = endpoint('/api/LoadUserDataAll', structures.LoadAllResponse)
+    purchase_enkephalin_module = endpoint(
+        '/api/PurchaseEnkephalinModule', structures.MimbusBaseResponse, lambda num: {'num': num}, mutates=True,
+    )
+    enter_exp_dungeon = endpoint(
+        '/api/EnterExpDungeon', structures.MimbusBaseResponse, lambda dungeon_id: {'dungeonid': dungeon_id}, mutates=True,
+    )
+    exit_exp_dungeon = endpoint(
+        '/api/ExitExpDungeon', structures.MimbusBaseResponse, lambda: EXIT_EXP_DUNGEON_PARAMETERS, mutates=True,
+    )
+    unseal_mails = endpoint(
+        '/api/UnsealMails', structures.MimbusBaseResponse, lambda mail_id: {'mailIds': [mail_id]}, mutates=True,
+    )
@@ -6,8 +6,92 @@ class Config:
     DEBUG = os.getenv('DEBUG', False)
     BOT_TOKEN = os.getenv('BOT_TOKEN')
     AUTH_TOKEN_TTL = int(os.getenv('AUTH_TOKEN_TTL', 60 * 60))
+    AUTH_REFRESH_AHEAD = int(os.getenv('AUTH_REFRESH_AHEAD', 10 * 60))
+    AUTH_REFRESH_INTERVAL = float(os.getenv('AUTH_REFRESH_INTERVAL', 60))
+    AUTH_REFRESH_CONCURRENCY = int(os.getenv('AUTH_REFRESH_CONCURRENCY', 4))
+    AUTH_REFRESH_BATCH = int(os.getenv('AUTH_REFRESH_BATCH', 500))
+    AUTH_ACTIVE_USERS = int(os.getenv('AUTH_ACTIVE_USERS', 10_000))
+    AUTH_ACTIVE_WINDOW = float(os.getenv('AUTH_ACTIVE_WINDOW', 30 * 60))
+
+    BOT_MODE = os.getenv('BOT_MODE', 'polling')
+    WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+    WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+    WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+    WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+    WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+    WEBHOOK_CONCURRENCY = int(os.getenv('WEBHOOK_CONCURRENCY', 64))
+
+    METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+    # the endpoint is served only when a port is given, there is no port it could safely assume
+    METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+    METRICS_PATH = os.getenv('METRICS_PATH', '/metrics')
+
+    TOKEN_SERVICE_PATH = os.getenv('TOKEN_SERVICE_PATH', '/tmp/mimbus-token.sock')
+    TOKEN_SERVICE_POOL_SIZE = int(os.getenv('TOKEN_SERVICE_POOL_SIZE', 4))
+    TOKEN_SERVICE_TIMEOUT = float(os.getenv('TOKEN_SERVICE_TIMEOUT', 60))
+    TOKEN_SERVICE_CONCURRENCY = int(os.getenv('TOKEN_SERVICE_CONCURRENCY', 8))
+
+    FSM_STORAGE = os.getenv('FSM_STORAGE', 'sql')
+    FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', 10_000))
+    FSM_CACHE_TTL = float(os.getenv('FSM_CACHE_TTL', 60))
+    FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', 7 * 24 * 60 * 60))
+    GUARD_SESSION_TTL = int(os.getenv('GUARD_SESSION_TTL', 10 * 60))
+    GUARD_SESSION_LIMIT = int(os.getenv('GUARD_SESSION_LIMIT', 10_000))
+
+    HTTP_POOL_LIMIT = int(os.getenv('HTTP_POOL_LIMIT', 100))
+    HTTP_POOL_LIMIT_PER_PROXY = int(os.getenv('HTTP_POOL_LIMIT_PER_PROXY', 4))
+    HTTP_KEEPALIVE_TIMEOUT = float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', 15))
+
+    LOAD_ALL_CACHE_SIZE = int(os.getenv('LOAD_ALL_CACHE_SIZE', 10_000))
+    LOAD_ALL_CACHE_TTL = float(os.getenv('LOAD_ALL_CACHE_TTL', 30))
+
+    LEASE_TTL = int(os.getenv('LEASE_TTL', 60))
+
+    AUTOMATION_CONCURRENCY = int(os.getenv('AUTOMATION_CONCURRENCY', 10))
+    AUTOMATION_PROXY_CONCURRENCY = int(os.getenv('AUTOMATION_PROXY_CONCURRENCY', 2))
+    AUTOMATION_PAGE_SIZE = int(os.getenv('AUTOMATION_PAGE_SIZE', 1000))
+    AUTOMATION_RESYNC_INTERVAL = int(os.getenv('AUTOMATION_RESYNC_INTERVAL', 60 * 60))
+    AUTOMATION_MIN_INTERVAL = int(os.getenv('AUTOMATION_MIN_INTERVAL', 60 * 60))
+
+    STAMINA_RECOVER_INTERVAL = int(os.getenv('STAMINA_RECOVER_INTERVAL', 6 * 60))
+    # assumed until a user's own cap has been learned
+    STAMINA_CAP = int(os.getenv('STAMINA_CAP', 160))
+
+    TELEGRAM_RATE_LIMIT = float(os.getenv('TELEGRAM_RATE_LIMIT', 25))
+    TELEGRAM_CHAT_RATE_LIMIT = float(os.getenv('TELEGRAM_CHAT_RATE_LIMIT', 1))
+    TELEGRAM_SEND_CONCURRENCY = int(os.getenv('TELEGRAM_SEND_CONCURRENCY', 16))
+
+    DUNGEON_CONCURRENCY = int(os.getenv('DUNGEON_CONCURRENCY', 20))
+    DUNGEON_EXIT_ATTEMPTS = int(os.getenv('DUNGEON_EXIT_ATTEMPTS', 5))
+    DUNGEON_RETRY_DELAY = float(os.getenv('DUNGEON_RETRY_DELAY', 60))
+
+    BROADCAST_PAGE_SIZE = int(os.getenv('BROADCAST_PAGE_SIZE', 100))
+
+    USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10_000))
+    USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 60))
+
+    MEMBERSHIP_CACHE_SIZE = int(os.getenv('MEMBERSHIP_CACHE_SIZE', 100_000))
+    MEMBERSHIP_CACHE_TTL = float(os.getenv('MEMBERSHIP_CACHE_TTL', 60 * 60))
+    MEMBERSHIP_NEGATIVE_TTL = float(os.getenv('MEMBERSHIP_NEGATIVE_TTL', 60))
+
+    RETRY_ATTEMPTS = int(os.getenv('RETRY_ATTEMPTS', 4))
+    RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 0.2))
+    RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 5))
+    RETRY_DEADLINE = float(os.getenv('RETRY_DEADLINE', 30))
+    RETRY_BUDGET_RATE = float(os.getenv('RETRY_BUDGET_RATE', 2))
+    RETRY_BUDGET_BURST = float(os.getenv('RETRY_BUDGET_BURST', 20))
 
     USE_PRIVATE_PROXY = os.getenv('USE_PRIVATE_PROXY', True)
+    PROXY_RELOAD_INTERVAL = float(os.getenv('PROXY_RELOAD_INTERVAL', 60 * 60))
+    PROXY_LIST_TIMEOUT = float(os.getenv('PROXY_LIST_TIMEOUT', 30))
+    PROXY_SNAPSHOT_PATH = os.getenv('PROXY_SNAPSHOT_PATH', 'proxies.snapshot.json')
+    PROXY_VIRTUAL_NODES = int(os.getenv('PROXY_VIRTUAL_NODES', 160))
+    PROXY_MAX_SCAN = int(os.getenv('PROXY_MAX_SCAN', 256))
+    PROXY_FAILURE_THRESHOLD = int(os.getenv('PROXY_FAILURE_THRESHOLD', 3))
+    PROXY_COOLDOWN = float(os.getenv('PROXY_COOLDOWN', 5 * 60))
+    PROXY_PROBE_INTERVAL = float(os.getenv('PROXY_PROBE_INTERVAL', 60))
+    PROXY_PROBE_TIMEOUT = float(os.getenv('PROXY_PROBE_TIMEOUT', 5))
+    PROXY_PROBE_CONCURRENCY = int(os.getenv('PROXY_PROBE_CONCURRENCY', 20))
 
     ADMIN_ONLY = os.getenv('ADMIN_ONLY', False)
 
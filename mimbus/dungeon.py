@@ -0,0 +1,219 @@
+import asyncio
+import contextlib
+import functools
+import heapq
+import logging
+import random
+import time
+import typing as tp
+from datetime import datetime, timedelta
+
+import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql import select
+
+from aiogram.types import ReplyKeyboardMarkup
+from aiogram.utils.i18n import gettext, I18n
+
+from mimbus import cache, models
+from mimbus.client import MimbusClient
+from mimbus.config import Config
+from mimbus.lease import Leases
+from mimbus.middleware import AuthMiddleware
+from mimbus.sender import MessageSender
+from mimbus.utils import session_scope, format_exception, on_commit, release, user_locks
+
+
+class DungeonWorker:
+    # a battle lasts between 5 and 7 minutes of game time
+    DURATION = (5 * 60, 7 * 60)
+
+    logger = logging.getLogger('mimbus.dungeon')
+
+    def __init__(
+            self,
+            sender: MessageSender,
+            client: MimbusClient,
+            auth: AuthMiddleware,
+            i18n: I18n,
+            keyboard: tp.Callable[[models.User], ReplyKeyboardMarkup],
+    ):
+        self.sender = sender
+        self.client = client
+        self.auth = auth
+        self.i18n = i18n
+        self.keyboard = keyboard
+        self.leases = Leases(models.DungeonRun)
+
+        self.semaphore = asyncio.Semaphore(Config.DUNGEON_CONCURRENCY)
+        self.queue: list[tuple[datetime, int]] = []
+        # latest queued time by run, to tell whether a run moved by another process needs a new entry
+        self.exits: dict[int, datetime] = {}
+        self.running: set[int] = set()
+        self.wakeup = asyncio.Event()
+        self.loaded_at = float('-inf')
+        self.tasks: set[asyncio.Task] = set()
+
+    async def create(self, session: AsyncSession, user_id: int, dungeon_id: int) -> models.DungeonRun:
+        run = models.DungeonRun(
+            user_id=user_id,
+            dungeon_id=dungeon_id,
+            exit_at=datetime.now() + timedelta(seconds=random.uniform(*self.DURATION)),
+        )
+        session.add(run)
+        await session.flush()
+
+        on_commit(session, functools.partial(self.schedule, run.id, run.exit_at))
+        return run
+
+    def schedule(self, run_id: int, exit_at: datetime):
+        self.exits[run_id] = exit_at
+        heapq.heappush(self.queue, (exit_at, run_id))
+        self.wakeup.set()
+
+    async def load(self):
+        # runs held by a live process are left to it, those of a process that died come back once the lease runs out
+        async with session_scope(autocommit=False) as session:
+            query = select(models.DungeonRun.id, models.DungeonRun.exit_at).where(
+                models.DungeonRun.finished.is_(False),
+                sqlalchemy.or_(
+                    models.DungeonRun.lease_owner.is_(None),
+                    models.DungeonRun.lease_expires_at < datetime.now(),
+                ),
+            )
+            rows = (await session.execute(query)).all()
+
+        resumed = 0
+        for run_id, exit_at in rows:
+            if run_id not in self.running and run_id not in self.exits:
+                self.schedule(run_id, exit_at)
+                resumed += 1
+
+        self.loaded_at = time.monotonic()
+        self.logger.debug('Resumed %s dungeon runs', resumed)
+
+    async def exit(self, user: models.User) -> bool:
+        if (
+            not user.auth_token or
+            (datetime.now() - user.auth_token_created_at).total_seconds() > Config.AUTH_TOKEN_TTL
+        ):
+            if not await self.auth.auth_with_refresh_token(user):
+                return False
+
+        await self.client.exit_exp_dungeon(uid=user.uid, auth_code=user.auth_token)
+        return True
+
+    async def finish(self, run_id: int):
+        async with session_scope(autocommit=False) as session:
+            run = await session.get(models.DungeonRun, run_id)
+
+        # stale heap entries are skipped: the run was rescheduled or is already done
+        if run is None or run.finished:
+            self.exits.pop(run_id, None)
+            return
+
+        if run.exit_at > datetime.now():
+            if self.exits.get(run_id) != run.exit_at:
+                self.schedule(run_id, run.exit_at)
+            return
+
+        # only the process holding the lease exits, the others look again once it could have run out
+        if not await self.leases.claim([run_id]):
+            self.schedule(run_id, datetime.now() + self.leases.ttl)
+            return
+
+        try:
+            await self.complete(run_id, run.user_id)
+        finally:
+            try:
+                await self.leases.release([run_id])
+            except Exception as e:
+                self.logger.error('Unable to release dungeon run %s. Error: %s', run_id, format_exception(e))
+
+    async def complete(self, run_id: int, user_id: int):
+        async with self.semaphore, user_locks(user_id), session_scope() as session:
+            run = await session.get(models.DungeonRun, run_id)
+            user = await session.get(models.User, run.user_id)
+            if run.finished:
+                return
+
+            await release(session)
+
+            if user is None:
+                run.finished = True
+                run.finished_at = datetime.now()
+                return
+
+            with self.i18n.context(), self.i18n.use_locale(user.language):
+                try:
+                    exited = await self.exit(user)
+                except Exception as e:
+                    self.logger.error('Unable to finish dungeon run %s. Error: %s', run_id, format_exception(e, with_traceback=True))
+
+                    run.attempts += 1
+                    if run.attempts < Config.DUNGEON_EXIT_ATTEMPTS:
+                        run.exit_at = datetime.now() + timedelta(seconds=Config.DUNGEON_RETRY_DELAY * run.attempts)
+                        on_commit(session, functools.partial(self.schedule, run.id, run.exit_at))
+                        return
+
+                    text = gettext('Unable to finish the battle. Contact admin.')
+                else:
+                    if exited:
+                        text = gettext('Battle finished!')
+                    else:
+                        text = gettext('Your refresh token is expired. Please, re-authenticate.')
+
+                    cache.invalidate_user(session, user.id)
+
+                run.finished = True
+                run.finished_at = datetime.now()
+
+                with contextlib.suppress(Exception):
+                    await self.sender.send(user.id, text, reply_markup=self.keyboard(user))
+
+    async def run(self, run_id: int):
+        self.running.add(run_id)
+        try:
+            await self.finish(run_id)
+        except Exception as e:
+            self.logger.error('Dungeon run %s failed. Error: %s', run_id, format_exception(e, with_traceback=True))
+            # the run is still pending in the database, so it is tried again rather than left for a restart
+            self.schedule(run_id, datetime.now() + timedelta(seconds=Config.DUNGEON_RETRY_DELAY))
+        finally:
+            self.running.discard(run_id)
+
+            # nothing is queued for the run any more once it is finished
+            if self.exits.get(run_id, datetime.max) <= datetime.now():
+                del self.exits[run_id]
+
+    async def loop(self):
+        while True:
+            if time.monotonic() - self.loaded_at >= self.leases.ttl.total_seconds():
+                try:
+                    await self.load()
+                except Exception as e:
+                    self.logger.error('Unable to load dungeon runs. Error: %s', format_exception(e, with_traceback=True))
+                    self.loaded_at = time.monotonic()
+
+            now = datetime.now()
+            while self.queue and self.queue[0][0] <= now:
+                _, run_id = heapq.heappop(self.queue)
+                if run_id in self.running:
+                    continue
+
+                task = asyncio.create_task(self.run(run_id))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+            timeout = self.loaded_at + self.leases.ttl.total_seconds() - time.monotonic()
+            if self.queue:
+                timeout = min(timeout, (self.queue[0][0] - now).total_seconds())
+
+            self.wakeup.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.wakeup.wait(), max(timeout, 0))
+
+    def start(self):
+        self.logger.debug('Starting dungeon worker')
+        self.leases.start()
+        asyncio.create_task(self.loop())
@@ -28,3 +28,10 @@ class APIException(UserException):
 
 class SteamException(MimbusException):
     pass
+
+
+class TokenServiceUnavailable(UserException):
+    MESSAGE = lazy_gettext(
+        'Steam login service is temporarily unavailable. '
+        'Please, try again later.'
+    )
@@ -0,0 +1,118 @@
+import asyncio
+import collections
+import logging
+import os
+import socket
+import typing as tp
+import uuid
+from datetime import datetime, timedelta
+
+import sqlalchemy
+from sqlalchemy.sql import select, update
+
+from mimbus.config import Config
+from mimbus.utils import Base, engine, session_scope, format_exception
+
+
+class Leases:
+    # time-limited claims on rows, so that processes sharing the database never work on the same one at once;
+    # held leases are renewed by a heartbeat until released, and a lease whose owner died simply expires
+    logger = logging.getLogger('mimbus.lease')
+
+    def __init__(self, model: type[Base], ttl: float = Config.LEASE_TTL):
+        self.model = model
+        self.ttl = timedelta(seconds=ttl)
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        # overlapping jobs in this process may hold the same row, it is freed by the last one
+        self.held: collections.Counter[int] = collections.Counter()
+
+    def free(self, now: datetime) -> sqlalchemy.ColumnElement[bool]:
+        return sqlalchemy.or_(
+            self.model.lease_owner.is_(None),
+            self.model.lease_owner == self.owner,
+            self.model.lease_expires_at < now,
+        )
+
+    async def claim(self, ids: tp.Collection[int]) -> set[int]:
+        if not ids:
+            return set()
+
+        now = datetime.now()
+        values = {'lease_owner': self.owner, 'lease_expires_at': now + self.ttl}
+
+        async with session_scope() as session:
+            if engine.dialect.name == 'postgresql':
+                # rows another worker is claiming right now are skipped instead of waited for
+                query = select(self.model.id).where(
+                    self.model.id.in_(ids),
+                    self.free(now),
+                ).with_for_update(
+                    skip_locked=True,
+                )
+                claimed = set((await session.execute(query)).scalars().all())
+
+                if claimed:
+                    await session.execute(update(self.model).where(self.model.id.in_(claimed)).values(**values))
+            else:
+                # a conditional update is atomic on its own, whoever updates the row first wins it
+                query = update(self.model).where(
+                    self.model.id.in_(ids),
+                    self.free(now),
+                ).values(
+                    **values,
+                ).returning(
+                    self.model.id,
+                )
+                claimed = set((await session.execute(query)).scalars().all())
+
+        self.held.update(claimed)
+        return claimed
+
+    async def release(self, ids: tp.Collection[int]):
+        released = []
+        for id_ in ids:
+            self.held[id_] -= 1
+            if self.held[id_] <= 0:
+                del self.held[id_]
+                released.append(id_)
+
+        if not released:
+            return
+
+        async with session_scope() as session:
+            await session.execute(
+                update(self.model).where(
+                    self.model.id.in_(released),
+                    self.model.lease_owner == self.owner,
+                ).values(
+                    lease_owner=None,
+                    lease_expires_at=None,
+                )
+            )
+
+    async def renew(self):
+        if not self.held:
+            return
+
+        async with session_scope() as session:
+            await session.execute(
+                update(self.model).where(
+                    self.model.id.in_(list(self.held)),
+                    self.model.lease_owner == self.owner,
+                ).values(
+                    lease_expires_at=datetime.now() + self.ttl,
+                )
+            )
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(self.ttl.total_seconds() / 3)
+
+            try:
+                await self.renew()
+            except Exception as e:
+                self.logger.error('Unable to renew %s leases. Error: %s', len(self.held), format_exception(e))
+
+    def start(self):
+        self.logger.debug('Holding leases as %s', self.owner)
+        asyncio.create_task(self.heartbeat())
@@ -0,0 +1,233 @@
+import abc
+import bisect
+import logging
+import time
+import typing as tp
+
+from aiohttp import web
+
+from mimbus import utils
+from mimbus.config import Config
+
+Labels = tuple[str, ...]
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+BATCH_BUCKETS = (.1, .5, 1, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+logger = logging.getLogger('mimbus.metrics')
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names: Labels, values: Labels, extra: str = '') -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# metrics are plain in-process counters, so recording one is a dict update; all formatting happens on scrape
+class Metric(abc.ABC):
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Labels = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+
+        registry.append(self)
+
+    @abc.abstractmethod
+    def samples(self) -> tp.Iterator[tuple[str, Labels, str, float]]:
+        ...
+
+    def render(self) -> tp.Iterator[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.type}'
+
+        for suffix, labels, extra, value in self.samples():
+            yield f'{self.name}{suffix}{format_labels(self.labelnames, labels, extra)} {format_value(value)}'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Labels = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield '', labels, '', value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Labels = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[Labels, float] = {}
+        self.function: tp.Callable[[], float] | None = None
+
+    def set(self, value: float, *labels: str):
+        self.values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set_function(self, function: tp.Callable[[], float]):
+        # read at scrape time, for values some component already keeps
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            yield '', (), '', self.function()
+            return
+
+        for labels, value in self.values.items():
+            yield '', labels, '', value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Labels = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        # per label set: a count for each bucket plus +Inf, then the sum
+        self.values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels: str):
+        if (series := self.values.get(labels)) is None:
+            series = self.values[labels] = ([0] * (len(self.buckets) + 1), [0.])
+
+        counts, total = series
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def time(self, *labels: str) -> 'Timer':
+        return Timer(self, labels)
+
+    def samples(self):
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                cumulative += count
+                yield '_bucket', labels, f'le="{format_value(bound)}"', cumulative
+
+            yield '_sum', labels, '', total[0]
+            yield '_count', labels, '', cumulative
+
+
+class Timer:
+    def __init__(self, histogram: Histogram, labels: Labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.started_at = 0.
+
+    def __enter__(self):
+        self.started_at = time.monotonic()
+        return self
+
+    def __exit__(self, *_):
+        self.histogram.observe(time.monotonic() - self.started_at, *self.labels)
+
+
+class RetryCounter(Metric):
+    type = 'counter'
+
+    def samples(self):
+        # utils.retry keeps its own counter so that it does not depend on this module
+        for (function, outcome), value in list(utils.retry_metrics.items()):
+            yield '', (function, outcome), '', value
+
+
+registry: list[Metric] = []
+
+client_request_seconds = Histogram(
+    'mimbus_client_request_seconds', 'Game API request latency.', ('endpoint', 'proxy'),
+)
+client_requests = Counter(
+    'mimbus_client_requests_total', 'Game API requests by outcome: the game state, an HTTP status, timeout or connection.',
+    ('endpoint', 'proxy', 'code'),
+)
+retries = RetryCounter(
+    'mimbus_retries_total', 'Retries by function and outcome: retry, exhausted, deadline or budget.', ('function', 'outcome'),
+)
+
+middleware_seconds = Histogram(
+    'mimbus_middleware_seconds', 'Time spent in a message middleware itself, excluding the rest of the chain.', ('middleware',),
+)
+handler_seconds = Histogram(
+    'mimbus_handler_seconds', 'Message handler latency.', ('handler',),
+)
+
+automation_batch_seconds = Histogram(
+    'mimbus_automation_batch_seconds', 'Time to work through one batch of due automation jobs.', (), BATCH_BUCKETS,
+)
+automation_jobs = Counter(
+    'mimbus_automation_jobs_total', 'Finished automation jobs.', ('kind', 'result'),
+)
+automation_backlog = Gauge(
+    'mimbus_automation_backlog', 'Automation jobs that are due but not finished yet.',
+)
+automation_lag_seconds = Histogram(
+    'mimbus_automation_lag_seconds', 'How late an automation job started compared to its schedule.', ('kind',), BATCH_BUCKETS,
+)
+automation_scheduled = Gauge(
+    'mimbus_automation_scheduled_users', 'Users with auto-assembly scheduled in this process.',
+)
+
+telegram_messages = Counter(
+    'mimbus_telegram_messages_total', 'Telegram sends by priority and result: sent, failed or retry_after.', ('priority', 'result'),
+)
+telegram_queue = Gauge(
+    'mimbus_telegram_queue_size', 'Messages waiting to be sent.',
+)
+
+
+def render() -> str:
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
+
+
+async def handle(_: web.Request) -> web.Response:
+    return web.Response(body=render().encode(), headers={'Content-Type': CONTENT_TYPE, 'Cache-Control': 'no-store'})
+
+
+async def start() -> web.AppRunner | None:
+    if not Config.METRICS_PORT:
+        return None
+
+    app = web.Application()
+    app.router.add_get(Config.METRICS_PATH, handle)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, Config.METRICS_HOST, Config.METRICS_PORT).start()
+    except OSError as e:
+        # another process on this host may already serve the port, which must not stop the bot
+        logger.error('Unable to serve metrics on %s:%s. Error: %s', Config.METRICS_HOST, Config.METRICS_PORT, e)
+        await runner.cleanup()
+        return None
+
+    logger.info('Serving metrics on %s:%s%s', Config.METRICS_HOST, Config.METRICS_PORT, Config.METRICS_PATH)
+    return runner
@@ -1,29 +1,64 @@
+import asyncio
 import base64
+import functools
 import logging
+import time
 import typing as tp
 
 from aiogram import BaseMiddleware, Bot
-from aiogram.types import Message, ReplyKeyboardRemove, TelegramObject
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import ChatMemberUpdated, Message, ReplyKeyboardRemove, TelegramObject
 from aiogram.utils.i18n import gettext, I18nMiddleware
-from async_lru import alru_cache
-from datetime import datetime
+from datetime import datetime, timedelta
+from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy.sql import select
 
-from mimbus import models, structures
+from mimbus import cache, metrics, models, structures
 from mimbus.client import MimbusClient
 from mimbus.config import Config
-from mimbus.exceptions import SteamException, UserException
+from mimbus.exceptions import RetryException, SteamException, UserException
+from mimbus.sender import MessageSender, Priority
 from mimbus.state import AuthState
-from mimbus.utils import session_scope, generate_token, format_exception
+from mimbus.utils import (
+    SingleFlight,
+    user_locks,
+    session_scope,
+    generate_session,
+    generate_token,
+    format_exception,
+    on_commit,
+    has_changes,
+    commit,
+    release,
+)
 
 Handler = tp.Callable[[Message, dict[str, tp.Any]], tp.Awaitable[tp.Any]]
 
 
+class UserLockMiddleware(BaseMiddleware):
+    async def __call__(self, handler: Handler, event: Message, data: dict[str, tp.Any]):
+        # handlers flagged with `user_lock` run one at a time per user; registered before SessionMiddleware
+        # so the user row is loaded only once the previous update for the same user has committed.
+        # The lock is per process, across processes models.User.version rejects the losing write
+        if not get_flag(data, 'user_lock'):
+            return await handler(event, data)
+
+        async with user_locks(event.from_user.id):
+            return await handler(event, data)
+
+
 class SessionMiddleware(BaseMiddleware):
     async def __call__(self, handler: Handler, event: Message, data: dict[str, tp.Any]):
-        async with session_scope() as session:
+        # AsyncSession checks out a connection only on first use, and the transaction is
+        # committed only if the handler actually changed something
+        async with generate_session() as session:
             data['session'] = session
-            return await handler(event, data)
+            result = await handler(event, data)
+
+            if has_changes(session):
+                await commit(session)
+
+            return result
 
 
 class UserMiddleware(BaseMiddleware):
@@ -33,50 +68,95 @@ class UserMiddleware(BaseMiddleware):
         if not (session := data.get('session')):
             raise RuntimeError('SessionMiddleware is not enabled')
 
-        query = select(models.User).where(models.User.id == event.from_user.id)
-        user = (await session.execute(query)).scalar_one_or_none()
+        user_id = event.from_user.id
+        if (values := cache.users.get(user_id)) is not None:
+            # other processes may have changed the row since it was cached, only its version is read to tell
+            query = select(models.User.version).where(models.User.id == user_id)
+            if (await session.execute(query)).scalar_one_or_none() != values['version']:
+                values = None
+
+        if values is not None:
+            user = cache.restore_user(session, values)
+        else:
+            query = select(models.User).where(models.User.id == user_id)
+            user = (await session.execute(query)).scalar_one_or_none()
+
+            # cached right away, since read-only requests never commit and never reach the on_commit below
+            if user is not None and (values := cache.snapshot_user(user)) is not None:
+                cache.users.set(user_id, values)
+
+        await release(session)
 
         if not user:
             self.logger.info('New user: %s', event.from_user.username)
-            user = models.User(id=event.from_user.id, tg_name=event.from_user.username)
+            user = models.User(id=user_id, tg_name=event.from_user.username)
             session.add(user)
 
         data['user'] = user
-        return await handler(event, data)
+        result = await handler(event, data)
+
+        # flush only dirty columns now and publish the row to the cache once the session commits
+        try:
+            await session.flush()
+        except StaleDataError:
+            # another process updated the row after it was read; its write stands and the next update reloads it
+            cache.users.pop(user_id)
+            raise
+
+        if (values := cache.snapshot_user(user)) is not None:
+            on_commit(session, functools.partial(cache.users.set, user_id, values))
+
+        return result
 
 
 class AuthMiddleware(BaseMiddleware):
     logger = logging.getLogger('mimbus.middleware.auth')
 
-    def __init__(self):
-        self.client = MimbusClient()
+    def __init__(self, client: MimbusClient):
+        self.client = client
+        self.flights = SingleFlight()
 
-    async def auth_with_refresh_token(self, user: models.User) -> bool:
+        # recently active users, whose tokens the background refresher keeps warm
+        self.seen: cache.TTLCache[int, bool] = cache.TTLCache(Config.AUTH_ACTIVE_USERS, Config.AUTH_ACTIVE_WINDOW)
+
+    async def refresh(self, refresh_token: str, uid: int | None) -> structures.UserAuth | None:
+        # only a rejection from Steam clears the credentials, TokenServiceUnavailable propagates
         try:
-            resp = await generate_token({'refreshToken': user.refresh_token})
+            resp = await generate_token({'refreshToken': refresh_token})
         except SteamException:
-            user.refresh_token = None
-            user.auth_token = None
-            return False
+            return None
 
         if resp.token is None:
-            user.refresh_token = None
-            user.auth_token = None
-            return False
+            return None
 
         try:
-            sign_in: structures.SteamLoginResponse = await self.client.sign_in(resp.token, uid=user.uid)
+            sign_in: structures.SteamLoginResponse = await self.client.sign_in(resp.token, uid=uid)
+        except RetryException:
+            # the game was unreachable, which says nothing about the refresh token
+            raise
         except Exception as e:
             self.logger.error('Unable to get the auth token. Error: %s', format_exception(e, with_traceback=True))
+            return None
 
+        return sign_in.result.user_auth
+
+    async def auth_with_refresh_token(self, user: models.User) -> bool:
+        # concurrent refreshes for the same user share one Steam login and sign-in,
+        # and every waiter applies the outcome to its own copy of the user
+        user_auth = await self.flights.do(
+            (user.id, user.refresh_token),
+            functools.partial(self.refresh, user.refresh_token, user.uid),
+        )
+
+        if user_auth is None:
             user.refresh_token = None
             user.auth_token = None
             return False
 
         self.logger.debug('Token granted for user %s', user.tg_name)
 
-        user.auth_token = sign_in.result.user_auth.auth_code
-        user.uid = sign_in.result.user_auth.uid
+        user.auth_token = user_auth.auth_code
+        user.uid = user_auth.uid
         user.auth_token_created_at = datetime.now()
         return True
 
@@ -84,6 +164,8 @@ class AuthMiddleware(BaseMiddleware):
         if not (user := data.get('user')):
             raise RuntimeError('UserMiddleware is not enabled')
 
+        self.seen.set(user.id, True)
+
         if (
             user.refresh_token and
             (
@@ -115,15 +197,16 @@ class AuthMiddleware(BaseMiddleware):
 class ExceptionMiddleware(BaseMiddleware):
     logger = logging.getLogger('mimbus.middleware.exception')
 
-    def __init__(self, bot: Bot):
-        self.bot = bot
+    def __init__(self, sender: MessageSender):
+        self.sender = sender
 
     async def send_to_escalation_chat(self, event: Message, data: dict[str, tp.Any], e: Exception):
-        await self.bot.send_message(
+        await self.sender.send(
             Config.ESCALATION_CHAT_ID,
             f'User: {data["user"].id}\n'
             f'Message: {event.text}\n\n'
             f'Unhandled exception: {format_exception(e, with_traceback=True)}',
+            priority=Priority.INTERACTIVE,
         )
 
     async def __call__(self, handler: Handler, event: Message, data: dict[str, tp.Any]):
@@ -153,18 +236,65 @@ class StatusMiddleware(BaseMiddleware):
     main_group_id = -2 * 773 * 7193 * 90073
     main_group_link = base64.b64decode('aHR0cHM6Ly90Lm1lL2xjYl9ndWlkZXNfcnU=').decode()
 
+    NEGATIVE_STATUSES = ('left', 'kicked')
+
+    logger = logging.getLogger('mimbus.middleware.status')
+
     def __init__(self, bot: Bot):
         self.bot = bot
+        self.statuses: cache.TTLCache[int, str] = cache.TTLCache(Config.MEMBERSHIP_CACHE_SIZE, Config.MEMBERSHIP_CACHE_TTL)
+        self.requests = SingleFlight()
+        self.tasks: set[asyncio.Task] = set()
 
-    @alru_cache(ttl=60 * 60)
-    async def get_status(self, user_id: int) -> str:
+    def ttl(self, status: str) -> float:
+        return Config.MEMBERSHIP_NEGATIVE_TTL if status in self.NEGATIVE_STATUSES else Config.MEMBERSHIP_CACHE_TTL
+
+    async def load(self):
+        async with session_scope(autocommit=False) as session:
+            query = select(models.Membership).where(
+                models.Membership.checked_at > datetime.now() - timedelta(seconds=Config.MEMBERSHIP_CACHE_TTL),
+            )
+            memberships = (await session.execute(query)).scalars().all()
+
+        for membership in memberships:
+            ttl = self.ttl(membership.status) - (datetime.now() - membership.checked_at).total_seconds()
+            if ttl > 0:
+                self.statuses.set(membership.user_id, membership.status, ttl=ttl)
+
+        self.logger.debug('Loaded %s memberships', len(self.statuses))
+
+    async def persist(self, user_id: int, status: str):
+        try:
+            async with session_scope() as session:
+                await session.merge(models.Membership(user_id=user_id, status=status, checked_at=datetime.now()))
+        except Exception as e:
+            self.logger.error('Unable to persist membership of %s. Error: %s', user_id, format_exception(e))
+
+    def remember(self, user_id: int, status: str):
+        self.statuses.set(user_id, status, ttl=self.ttl(status))
+
+        task = asyncio.create_task(self.persist(user_id, status))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def fetch(self, user_id: int) -> str:
         res = await self.bot.get_chat_member(self.main_group_id, user_id)
+        self.remember(user_id, res.status)
         return res.status
 
+    async def get_status(self, user_id: int) -> str:
+        if (status := self.statuses.get(user_id)) is not None:
+            return status
+
+        return await self.requests.do(user_id, functools.partial(self.fetch, user_id))
+
+    def on_chat_member(self, event: ChatMemberUpdated):
+        if event.chat.id == self.main_group_id:
+            self.remember(event.new_chat_member.user.id, event.new_chat_member.status)
+
     async def __call__(self, handler: Handler, event: Message, data: dict[str, tp.Any]):
         status = await self.get_status(event.from_user.id)
         if status == 'left':
-            self.get_status.cache_invalidate(event.from_user.id)
             await event.answer(
                 gettext(
                     'Please, subscribe to our group to continue.\n'
@@ -189,3 +319,34 @@ class AdminOnlyMiddleware(BaseMiddleware):
             return
 
         return await handler(event, data)
+
+
+class TimedMiddleware(BaseMiddleware):
+    # records the time spent in the wrapped middleware itself, the rest of the chain is subtracted
+    def __init__(self, middleware: BaseMiddleware):
+        self.middleware = middleware
+        self.name = type(middleware).__name__
+
+    async def __call__(self, handler: Handler, event: Message, data: dict[str, tp.Any]):
+        inner = 0.
+
+        async def timed(event: Message, data: dict[str, tp.Any]):
+            nonlocal inner
+            started_at = time.monotonic()
+            try:
+                return await handler(event, data)
+            finally:
+                inner += time.monotonic() - started_at
+
+        started_at = time.monotonic()
+        try:
+            return await self.middleware(timed, event, data)
+        finally:
+            metrics.middleware_seconds.observe(time.monotonic() - started_at - inner, self.name)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # registered last, so `handler` is the only thing left in the chain
+    async def __call__(self, handler: Handler, event: Message, data: dict[str, tp.Any]):
+        with metrics.handler_seconds.time(data['handler'].callback.__name__):
+            return await handler(event, data)
@@ -22,7 +22,112 @@ class User(Base):
     last_assembled_at = sqlalchemy.Column(sqlalchemy.DateTime, server_default='1970-01-01 00:00:00')
     notification_sent = sqlalchemy.Column(sqlalchemy.Boolean, server_default='false')
 
+    # last stamina reading and when it last went up, used to predict the next assembly
+    stamina = sqlalchemy.Column(sqlalchemy.Integer)
+    stamina_recovered_at = sqlalchemy.Column(sqlalchemy.DateTime)
+    # where regeneration stops for this user, learned from the readings; Config.STAMINA_CAP until then
+    stamina_cap = sqlalchemy.Column(sqlalchemy.Integer)
+
+    # which process is handling the row right now, see mimbus.lease
+    lease_owner = sqlalchemy.Column(sqlalchemy.Text)
+    lease_expires_at = sqlalchemy.Column(sqlalchemy.DateTime)
+
     auth_token = sqlalchemy.Column(sqlalchemy.Text)
     auth_token_created_at = sqlalchemy.Column(sqlalchemy.DateTime)
 
     created_at = sqlalchemy.Column(sqlalchemy.DateTime, server_default=func.now())
+
+    # bumped by every ORM update, which also requires the version it read; a row changed by another process
+    # meanwhile fails the flush instead of being overwritten, and cached copies are checked against it
+    version = sqlalchemy.Column(sqlalchemy.Integer, server_default='0')
+
+    __mapper_args__ = {'version_id_col': version}
+
+    __table_args__ = (
+        # serves the automation scheduler's keyset scan over auto-assemble users only
+        sqlalchemy.Index(
+            'ix_users_auto_assemble_schedule',
+            last_assembled_at,
+            id,
+            postgresql_where=auto_assemble.is_(True),
+            postgresql_include=['notification_sent', 'stamina', 'stamina_recovered_at', 'stamina_cap'],
+            sqlite_where=auto_assemble.is_(True),
+        ),
+    )
+
+
+class Broadcast(Base):
+    __tablename__ = 'broadcasts'
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    text = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+    created_by = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False)
+
+    finished = sqlalchemy.Column(sqlalchemy.Boolean, nullable=False, default=False)
+    last_user_id = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False, default=0)
+    delivered = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+    failed = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+
+    lease_owner = sqlalchemy.Column(sqlalchemy.Text)
+    lease_expires_at = sqlalchemy.Column(sqlalchemy.DateTime)
+
+    created_at = sqlalchemy.Column(sqlalchemy.DateTime, server_default=func.now())
+    finished_at = sqlalchemy.Column(sqlalchemy.DateTime)
+
+
+class Membership(Base):
+    __tablename__ = 'memberships'
+
+    user_id = sqlalchemy.Column(sqlalchemy.BigInteger, primary_key=True)
+    status = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+    checked_at = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False)
+
+
+class DungeonRun(Base):
+    __tablename__ = 'dungeon_runs'
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    user_id = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False)
+    dungeon_id = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+
+    exit_at = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False)
+    attempts = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+    finished = sqlalchemy.Column(sqlalchemy.Boolean, nullable=False, default=False)
+
+    lease_owner = sqlalchemy.Column(sqlalchemy.Text)
+    lease_expires_at = sqlalchemy.Column(sqlalchemy.DateTime)
+
+    created_at = sqlalchemy.Column(sqlalchemy.DateTime, server_default=func.now())
+    finished_at = sqlalchemy.Column(sqlalchemy.DateTime)
+
+    __table_args__ = (
+        # pending runs are reloaded on start
+        sqlalchemy.Index(
+            'ix_dungeon_runs_pending',
+            exit_at,
+            postgresql_where=finished.is_(False),
+            sqlite_where=finished.is_(False),
+        ),
+    )
+
+
+class FSMState(Base):
+    __tablename__ = 'fsm_states'
+
+    bot_id = sqlalchemy.Column(sqlalchemy.BigInteger, primary_key=True)
+    chat_id = sqlalchemy.Column(sqlalchemy.BigInteger, primary_key=True)
+    user_id = sqlalchemy.Column(sqlalchemy.BigInteger, primary_key=True)
+    destiny = sqlalchemy.Column(sqlalchemy.Text, primary_key=True)
+
+    state = sqlalchemy.Column(sqlalchemy.Text)
+    data = sqlalchemy.Column(sqlalchemy.Text)
+
+    updated_at = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False, index=True)
+
+
+class GuardSession(Base):
+    __tablename__ = 'guard_sessions'
+
+    user_id = sqlalchemy.Column(sqlalchemy.BigInteger, primary_key=True)
+    login_id = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False)
+    created_at = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False, index=True)
@@ -2,9 +2,13 @@ import aiohttp
 import asyncio
 import bisect
 import contextlib
+import heapq
 import json
 import logging
 import mmh3
+import os
+import time
+import typing as tp
 
 from mimbus.config import Config
 
@@ -13,74 +17,309 @@ def int_to_bytes(x: int) -> bytes:
     return x.to_bytes((x.bit_length() + 7) // 8, 'big')
 
 
+def iter_json_array(f: tp.TextIO, chunk_size: int = 64 * 1024) -> tp.Iterator[tp.Any]:
+    decoder = json.JSONDecoder()
+    buffer = ''
+    started = False
+
+    while True:
+        chunk = f.read(chunk_size)
+        buffer += chunk
+        position = 0
+
+        while True:
+            # skip whitespace and the array punctuation between items
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+
+            if position < len(buffer) and not started:
+                if buffer[position] != '[':
+                    raise ValueError('Expected a JSON array')
+
+                started = True
+                position += 1
+                continue
+
+            if position < len(buffer) and buffer[position] == ']':
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break
+
+            # a number or literal cut by the end of the chunk decodes as a shorter one ('45' of '456', '-7' of '-7.5'),
+            # so an item only counts once the separator after it has been read, or at the end of the input
+            if chunk and (end == len(buffer) or buffer[end] not in ' \t\r\n,]'):
+                break
+
+            position = end
+            yield item
+
+        buffer = buffer[position:]
+        if not chunk:
+            raise ValueError('Unexpected end of JSON array')
+
+
+def read_endpoints(path: str) -> set[str]:
+    with open(path, 'r') as f:
+        return {f'http://{proxy}' for proxy in iter_json_array(f)}
+
+
+class ProxyHealth:
+    ALPHA = 0.2
+
+    def __init__(self):
+        self.latency: float | None = None
+        self.error_rate = 0.
+        self.failures = 0
+        self.opened_at: float | None = None
+
+    @property
+    def score(self) -> float | None:
+        if self.latency is None:
+            return None
+
+        return self.latency * (1 + 4 * self.error_rate)
+
+    def success(self, latency: float):
+        self.latency = latency if self.latency is None else (1 - self.ALPHA) * self.latency + self.ALPHA * latency
+        self.error_rate = (1 - self.ALPHA) * self.error_rate
+        self.failures = 0
+
+    def failure(self):
+        self.error_rate = (1 - self.ALPHA) * self.error_rate + self.ALPHA
+        self.failures += 1
+
+
 class ProxyStorage:
     logger = logging.getLogger('mimbus.proxy')
 
     def __init__(self):
-        self.proxies: dict[int, str | None] = {}
-        self.indexes: list[int] = []
+        self.hosts: set[str] = set()
+        self.dead: set[str] = set()
+        self.health: dict[str, ProxyHealth] = {}
 
-    async def load(self):
-        proxies = {}
-        indexes = []
+        # consistent-hash ring: sorted virtual node hashes and the host owning each of them
+        self.ring: list[int] = []
+        self.owners: list[str] = []
+        self.ring_hosts: set[str] = set()
 
-        if Config.USE_PRIVATE_PROXY:
-            with open('endpoints.json', 'r') as f:
-                resp = json.load(f)
+        self.loaded_at: float | None = None
+
+    @staticmethod
+    def key(uid: int) -> int:
+        return mmh3.hash(int_to_bytes(abs(uid)))
+
+    def build(self, hosts: tp.Iterable[str]):
+        points = sorted(
+            (mmh3.hash(f'{host}#{i}'), host)
+            for host in hosts
+            for i in range(Config.PROXY_VIRTUAL_NODES)
+        )
+
+        self.ring = [h for h, _ in points]
+        self.owners = [host for _, host in points]
+        self.ring_hosts = set(self.owners)
+
+    def compact(self):
+        # drops tombstoned virtual nodes from the ring once they make up a quarter of it,
+        # unless that would leave nothing to fall back to
+        if len(self.dead & self.ring_hosts) * 4 <= len(self.ring_hosts):
+            return
+
+        if alive := self.hosts - self.dead:
+            self.build(alive)
+
+    def update(self, hosts: set[str]):
+        added = hosts - self.hosts
+        removed = self.hosts - hosts
+
+        if removed:
+            points = [(h, host) for h, host in zip(self.ring, self.owners) if host not in removed]
         else:
-            async with aiohttp.ClientSession() as session:
-                async with session.get('https://raw.githubusercontent.com/jetkai/proxy-list/main/online-proxies/json/proxies.json') as response:
-                    resp = json.loads(await response.text())['http']
+            points = list(zip(self.ring, self.owners))
+
+        if added:
+            points = list(heapq.merge(points, sorted(
+                (mmh3.hash(f'{host}#{i}'), host)
+                for host in added
+                for i in range(Config.PROXY_VIRTUAL_NODES)
+            )))
+
+        if added or removed:
+            self.ring = [h for h, _ in points]
+            self.owners = [host for _, host in points]
+            self.ring_hosts = (self.ring_hosts - removed) | added
+
+        for host in removed:
+            self.dead.discard(host)
+            self.health.pop(host, None)
+
+        for host in added:
+            self.health[host] = ProxyHealth()
+
+        self.hosts = hosts
+        self.logger.debug('Proxy list updated: %s added, %s removed, %s total', len(added), len(removed), len(hosts))
+
+    async def fetch(self) -> set[str]:
+        if Config.USE_PRIVATE_PROXY:
+            return await asyncio.to_thread(read_endpoints, 'endpoints.json')
+
+        timeout = aiohttp.ClientTimeout(total=Config.PROXY_LIST_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.get('https://raw.githubusercontent.com/jetkai/proxy-list/main/online-proxies/json/proxies.json') as response:
+                resp = json.loads(await response.text())['http']
+
+        return {f'http://{proxy}' for proxy in resp}
+
+    @staticmethod
+    def save_snapshot(snapshot: dict[str, list[str]]):
+        with open(f'{Config.PROXY_SNAPSHOT_PATH}.tmp', 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(f'{Config.PROXY_SNAPSHOT_PATH}.tmp', Config.PROXY_SNAPSHOT_PATH)
+
+    def load_snapshot(self) -> bool:
+        try:
+            with open(Config.PROXY_SNAPSHOT_PATH, 'r') as f:
+                snapshot = json.load(f)
+
+            # a snapshot of the wrong shape is ignored like a missing one, the live list is fetched instead
+            hosts, dead = set(snapshot['hosts']), set(snapshot['dead'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+        self.update(hosts)
+
+        now = time.monotonic()
+        for host in self.hosts.intersection(dead):
+            self.dead.add(host)
+            self.health[host].opened_at = now
+        self.compact()
 
-        for proxy in resp:
-            host = f'http://{proxy}'
-            h = mmh3.hash(host)
-            proxies[h] = host
-            indexes.append(h)
+        self.logger.debug('Loaded %s proxies from snapshot', len(self.hosts))
+        return bool(self.hosts)
 
-        indexes.sort()
+    async def load(self):
+        self.update(await self.fetch())
+        self.loaded_at = time.monotonic()
 
-        self.proxies = proxies
-        self.indexes = indexes
-        self.logger.debug('Loaded %s proxies', len(proxies))
+        try:
+            await asyncio.to_thread(self.save_snapshot, {'hosts': sorted(self.hosts), 'dead': sorted(self.dead)})
+        except OSError as e:
+            self.logger.warning('Unable to save proxy snapshot: %s', e)
 
     async def loop(self):
-        if self.proxies:
-            await asyncio.sleep(60 * 60)
+        if self.loaded_at is not None:
+            await asyncio.sleep(Config.PROXY_RELOAD_INTERVAL)
 
         while True:
-            with contextlib.suppress(Exception):
+            try:
                 await self.load()
+            except Exception as e:
+                self.logger.error('Unable to reload proxies: %s', e)
+
+            await asyncio.sleep(Config.PROXY_RELOAD_INTERVAL)
+
+    async def probe(self, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, url: str, host: str):
+        async with semaphore:
+            started_at = time.monotonic()
+            try:
+                # any HTTP answer means the proxy relayed the request
+                async with session.head(url, proxy=host):
+                    pass
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                self.record_failure(host)
+            else:
+                self.record_success(host, time.monotonic() - started_at)
+
+    async def probe_loop(self, url: str):
+        semaphore = asyncio.Semaphore(Config.PROXY_PROBE_CONCURRENCY)
+        timeout = aiohttp.ClientTimeout(total=Config.PROXY_PROBE_TIMEOUT)
 
-            await asyncio.sleep(60 * 60)
+        async with aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(force_close=True)) as session:
+            while True:
+                now = time.monotonic()
+                hosts = [
+                    host for host in self.hosts
+                    if host not in self.dead or now - self.health[host].opened_at > Config.PROXY_COOLDOWN
+                ]
 
-    def start(self):
+                with contextlib.suppress(Exception):
+                    await asyncio.gather(*(self.probe(session, semaphore, url, host) for host in hosts))
+
+                self.logger.debug('Probed %s proxies, %s of %s alive', len(hosts), len(self.hosts) - len(self.dead), len(self.hosts))
+                await asyncio.sleep(Config.PROXY_PROBE_INTERVAL)
+
+    def start(self, probe_url: str):
         self.logger.debug('Starting proxy storage')
         asyncio.create_task(self.loop())
+        asyncio.create_task(self.probe_loop(probe_url))
+
+    def remove(self, host: str | None):
+        if host not in self.hosts or host in self.dead:
+            return
+
+        self.dead.add(host)
+        self.health[host].opened_at = time.monotonic()
+        self.logger.debug('Proxy %s is marked as dead, %s of %s left', host, len(self.hosts) - len(self.dead), len(self.hosts))
+
+        self.compact()
+
+    def readmit(self, host: str):
+        self.dead.discard(host)
+        self.health[host].opened_at = None
+        self.logger.debug('Proxy %s is alive again', host)
+
+        if host not in self.ring_hosts:
+            self.build(self.hosts - self.dead)
+
+    def record_success(self, host: str | None, latency: float):
+        if (health := self.health.get(host)) is None:
+            return
+
+        health.success(latency)
+        if host in self.dead:
+            self.readmit(host)
+
+    def record_failure(self, host: str | None):
+        if (health := self.health.get(host)) is None:
+            return
+
+        health.failure()
+        if host in self.dead:
+            # failed half-open probe: keep the circuit open for another cool-down
+            health.opened_at = time.monotonic()
+        elif health.failures >= Config.PROXY_FAILURE_THRESHOLD:
+            self.remove(host)
 
-    def remove(self, uid: int):
-        result = self.proxies[self.indexes[self.get_index(uid)]]
-        if result is None:
-            return self.remove(mmh3.hash(int_to_bytes(abs(uid))))
+    def get(self, uid: int) -> str | None:
+        if not self.ring:
+            return None
 
-        self.proxies[self.indexes[self.get_index(uid)]] = None
+        size = len(self.ring)
+        index = bisect.bisect_left(self.ring, self.key(uid))
 
-    def get_index(self, uid: int) -> int:
-        if not self.proxies:
-            return 0
+        candidates = []
+        for i in range(min(size, Config.PROXY_MAX_SCAN)):
+            host = self.owners[(index + i) % size]
+            if host not in self.dead and host not in candidates:
+                candidates.append(host)
+                if len(candidates) == 2:
+                    break
 
-        index = bisect.bisect_left(self.indexes, mmh3.hash(int_to_bytes(abs(uid))))
-        if index == len(self.indexes):
-            index = 0
-        return index
+        if not candidates:
+            # every candidate within reach is dead: stay on the owner rather than going out without a proxy
+            return self.owners[index % size]
 
-    def get(self, uid: int) -> str:
-        index = self.get_index(uid)
+        # users stick to their own proxy unless it is markedly slower or flakier than the next one on the ring
+        host = candidates[0]
+        if len(candidates) == 2:
+            score, fallback_score = self.health[host].score, self.health[candidates[1]].score
+            if score is not None and fallback_score is not None and score > 2 * fallback_score:
+                return candidates[1]
 
-        result = self.proxies[self.indexes[index]]
-        if result is None:
-            return self.get(mmh3.hash(int_to_bytes(abs(uid))))
-        return result
+        return host
 
 
 storage = ProxyStorage()
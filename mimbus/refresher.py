@@ -0,0 +1,133 @@
+import asyncio
+import heapq
+import logging
+import operator
+import random
+from datetime import datetime, timedelta
+
+import sqlalchemy
+from sqlalchemy.sql import select
+
+from mimbus import cache, models
+from mimbus.automation import AutomationWorker
+from mimbus.config import Config
+from mimbus.exceptions import RetryException, TokenServiceUnavailable
+from mimbus.middleware import AuthMiddleware
+from mimbus.utils import session_scope, format_exception, release, user_locks
+
+
+class TokenRefresher:
+    logger = logging.getLogger('mimbus.refresher')
+
+    def __init__(self, auth: AuthMiddleware, worker: AutomationWorker):
+        self.auth = auth
+        self.worker = worker
+
+        self.semaphore = asyncio.Semaphore(Config.AUTH_REFRESH_CONCURRENCY)
+        self.pending: dict[int, asyncio.Task] = {}
+
+    @staticmethod
+    def threshold(now: datetime) -> datetime:
+        return now - timedelta(seconds=Config.AUTH_TOKEN_TTL - Config.AUTH_REFRESH_AHEAD)
+
+    def is_expiring(self, user: models.User | None, now: datetime) -> bool:
+        return (
+            user is not None and
+            user.refresh_token is not None and
+            (not user.auth_token or user.auth_token_created_at is None or user.auth_token_created_at < self.threshold(now))
+        )
+
+    def expiring(self, now: datetime) -> sqlalchemy.ColumnElement[bool]:
+        return sqlalchemy.and_(
+            models.User.refresh_token.is_not(None),
+            sqlalchemy.or_(
+                models.User.auth_token.is_(None),
+                models.User.auth_token_created_at.is_(None),
+                models.User.auth_token_created_at < self.threshold(now),
+            ),
+        )
+
+    async def candidates(self, now: datetime) -> list[tuple[int, datetime]]:
+        ahead = timedelta(seconds=Config.AUTH_REFRESH_AHEAD)
+        ttl = timedelta(seconds=Config.AUTH_TOKEN_TTL)
+
+        # only users who are about to need a token: those due for assembly and those chatting with the bot;
+        # everyone else still refreshes on demand
+        due = dict(heapq.nsmallest(
+            Config.AUTH_REFRESH_BATCH,
+            ((user_id, due) for user_id, due in self.worker.deadlines.items() if due <= now + ahead),
+            key=operator.itemgetter(1),
+        ))
+        if not (wanted := [*due, *self.auth.seen.keys()]):
+            return []
+
+        query = select(
+            models.User.id,
+            models.User.auth_token_created_at,
+        ).where(
+            self.expiring(now),
+            models.User.id.in_(wanted),
+        )
+
+        async with session_scope(autocommit=False) as session:
+            rows = (await session.execute(query)).all()
+
+        result = []
+        for user_id, created_at in rows:
+            needed_at = now + ahead if created_at is None else created_at + ttl
+            if user_id in due:
+                needed_at = min(needed_at, due[user_id])
+
+            result.append((user_id, needed_at))
+
+        return sorted(result, key=operator.itemgetter(1))
+
+    async def refresh(self, user_id: int, delay: float):
+        # jitter spreads a batch over the time left instead of hitting Steam all at once
+        await asyncio.sleep(delay)
+
+        try:
+            async with self.semaphore, user_locks(user_id), session_scope() as session:
+                user = await session.get(models.User, user_id)
+                if not self.is_expiring(user, datetime.now()):
+                    return
+
+                await release(session)
+
+                if await self.auth.auth_with_refresh_token(user):
+                    self.logger.debug('Token refreshed in background for user %s', user_id)
+
+                cache.invalidate_user(session, user_id)
+        except (TokenServiceUnavailable, RetryException) as e:
+            # the tokens are left as they are and the next scan picks the user up again
+            self.logger.warning('Unable to refresh token for user %s, will retry. Error: %s', user_id, e)
+        except Exception as e:
+            self.logger.error('Unable to refresh token for user %s. Error: %s', user_id, format_exception(e, with_traceback=True))
+
+    def schedule(self, user_id: int, needed_at: datetime, now: datetime):
+        if user_id in self.pending:
+            return
+
+        # leave half of the slack as headroom for a retry on the next scan
+        slack = (needed_at - now).total_seconds()
+        delay = random.uniform(0, max(0., slack / 2))
+
+        task = self.pending[user_id] = asyncio.create_task(self.refresh(user_id, delay))
+        task.add_done_callback(lambda _: self.pending.pop(user_id, None))
+
+    async def loop(self):
+        while True:
+            try:
+                now = datetime.now()
+                for user_id, needed_at in await self.candidates(now):
+                    self.schedule(user_id, needed_at, now)
+
+                self.logger.debug('%s token refreshes pending', len(self.pending))
+            except Exception as e:
+                self.logger.error('Unable to schedule token refreshes. Error: %s', format_exception(e, with_traceback=True))
+
+            await asyncio.sleep(Config.AUTH_REFRESH_INTERVAL)
+
+    def start(self):
+        self.logger.debug('Starting token refresher')
+        asyncio.create_task(self.loop())
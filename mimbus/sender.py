@@ -0,0 +1,106 @@
+import asyncio
+import enum
+import itertools
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import Message
+
+from mimbus import metrics
+from mimbus.config import Config
+from mimbus.utils import TokenBucket
+
+
+class Priority(enum.IntEnum):
+    INTERACTIVE = 0
+    NOTIFICATION = 1
+    BROADCAST = 2
+
+
+Item = tuple[Priority, int, int, dict, asyncio.Future]
+
+
+class MessageSender:
+    MAX_CHAT_BUCKETS = 10_000
+
+    logger = logging.getLogger('mimbus.sender')
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+
+        self.queue: asyncio.PriorityQueue[Item] = asyncio.PriorityQueue()
+        self.counter = itertools.count()
+        self.semaphore = asyncio.Semaphore(Config.TELEGRAM_SEND_CONCURRENCY)
+
+        self.bucket = TokenBucket(Config.TELEGRAM_RATE_LIMIT, Config.TELEGRAM_RATE_LIMIT)
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self.paused_until = 0.
+        self.tasks: set[asyncio.Task] = set()
+
+    def submit(self, chat_id: int, text: str, priority: Priority = Priority.NOTIFICATION, **kwargs) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((priority, next(self.counter), chat_id, {'text': text, **kwargs}, future))
+        return future
+
+    async def send(self, chat_id: int, text: str, priority: Priority = Priority.NOTIFICATION, **kwargs) -> Message:
+        return await self.submit(chat_id, text, priority, **kwargs)
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        if (bucket := self.chat_buckets.get(chat_id)) is None:
+            if len(self.chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                self.chat_buckets = {k: v for k, v in self.chat_buckets.items() if not v.full}
+
+            bucket = self.chat_buckets[chat_id] = TokenBucket(Config.TELEGRAM_CHAT_RATE_LIMIT, 1)
+
+        return bucket
+
+    async def deliver(self, item: Item):
+        priority, _, chat_id, kwargs, future = item
+        priority = Priority(priority).name.lower()
+
+        try:
+            result = await self.bot.send_message(chat_id, **kwargs)
+        except TelegramRetryAfter as e:
+            self.logger.warning('Flood control exceeded, pausing for %s seconds', e.retry_after)
+            metrics.telegram_messages.inc(priority, 'retry_after')
+            self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+            self.queue.put_nowait(item)
+        except Exception as e:
+            metrics.telegram_messages.inc(priority, 'failed')
+            if not future.done():
+                future.set_exception(e)
+        else:
+            metrics.telegram_messages.inc(priority, 'sent')
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self.semaphore.release()
+
+    async def loop(self):
+        while True:
+            if (pause := self.paused_until - time.monotonic()) > 0:
+                await asyncio.sleep(pause)
+
+            item = await self.queue.get()
+            chat_id, future = item[2], item[4]
+            if future.done():
+                continue
+
+            if (delay := self.chat_bucket(chat_id).delay()) > 0:
+                asyncio.get_running_loop().call_later(delay, self.queue.put_nowait, item)
+                continue
+
+            await self.bucket.acquire()
+            self.chat_bucket(chat_id).consume()
+
+            await self.semaphore.acquire()
+            task = asyncio.create_task(self.deliver(item))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def start(self):
+        self.logger.debug('Starting message sender')
+        metrics.telegram_queue.set_function(self.queue.qsize)
+        asyncio.create_task(self.loop())
@@ -0,0 +1,170 @@
+import asyncio
+import functools
+import itertools
+import logging
+import random
+import struct
+
+import orjson
+
+from mimbus import structures
+from mimbus.config import Config
+from mimbus.exceptions import SteamException, TokenServiceUnavailable
+
+
+class TokenServiceConnection:
+    HEADER = struct.Struct('>I')
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.reader_task: asyncio.Task | None = None
+
+    @property
+    def closed(self) -> bool:
+        return self.writer.is_closing() or self.reader_task is None or self.reader_task.done()
+
+    async def send(self, request: dict):
+        payload = orjson.dumps(request)
+        # a single write keeps frames from interleaving when several requests share the connection
+        self.writer.write(self.HEADER.pack(len(payload)) + payload)
+        await self.writer.drain()
+
+    async def receive(self) -> dict:
+        length, = self.HEADER.unpack(await self.reader.readexactly(self.HEADER.size))
+        return orjson.loads(await self.reader.readexactly(length))
+
+    def close(self):
+        self.writer.close()
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+
+
+class TokenServiceClient:
+    logger = logging.getLogger('mimbus.steam')
+
+    def __init__(self, path: str, pool_size: int, timeout: float, concurrency: int):
+        self.path = path
+        self.pool_size = pool_size
+        self.timeout = timeout
+
+        self.connections: list[TokenServiceConnection] = []
+        self.connecting = asyncio.Lock()
+        self.cursor = itertools.count()
+
+        # responses are matched to requests by id, whichever pooled connection they arrive on;
+        # a random start keeps ids apart from logins a previous process left pending on the service
+        self.ids = itertools.count(random.randrange(1 << 48))
+        self.pending: dict[int, asyncio.Future] = {}
+
+        # every login is a full Steam handshake on the service side
+        self.logins = asyncio.Semaphore(concurrency)
+
+    async def connect(self) -> TokenServiceConnection:
+        reader, writer = await asyncio.open_unix_connection(self.path)
+
+        connection = TokenServiceConnection(reader, writer)
+        connection.reader_task = asyncio.create_task(self.read_loop(connection))
+        return connection
+
+    async def acquire(self) -> TokenServiceConnection:
+        self.connections[:] = [c for c in self.connections if not c.closed]
+
+        if len(self.connections) < self.pool_size:
+            async with self.connecting:
+                if len(self.connections) < self.pool_size:
+                    try:
+                        connection = await self.connect()
+                    except OSError as e:
+                        if not self.connections:
+                            raise TokenServiceUnavailable(f'Token service is unavailable: {e}')
+
+                        self.logger.warning('Unable to open a token service connection: %s', e)
+                    else:
+                        self.connections.append(connection)
+
+        return self.connections[next(self.cursor) % len(self.connections)]
+
+    async def read_loop(self, connection: TokenServiceConnection):
+        try:
+            while True:
+                response = await connection.receive()
+
+                future = self.pending.pop(response.get('id'), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+
+        except (asyncio.IncompleteReadError, OSError, ValueError) as e:
+            self.logger.warning('Token service connection lost: %s', e)
+
+        finally:
+            connection.writer.close()
+
+    async def request(self, request: dict) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request['id']] = future
+
+        try:
+            async with self.logins:
+                connection = await self.acquire()
+                await connection.send(request)
+
+                # the future also settles if the connection drops, see `read_loop`
+                done, _ = await asyncio.wait(
+                    (future, connection.reader_task),
+                    timeout=self.timeout,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+        except OSError as e:
+            raise TokenServiceUnavailable(f'Token service is unavailable: {e}')
+        finally:
+            self.pending.pop(request['id'], None)
+
+        if future not in done:
+            future.cancel()
+            if connection.reader_task.done():
+                raise TokenServiceUnavailable('Token service connection lost')
+
+            raise TokenServiceUnavailable('Token service did not respond in time')
+
+        response = future.result()
+        if err := response.get('error'):
+            raise SteamException(err)
+
+        return response
+
+    def result(self, login_id: int, response: dict) -> structures.SteamTokenResponse:
+        if response.get('guard'):
+            return structures.SteamTokenResponse(
+                token=None,
+                refresh_token=None,
+                callback=functools.partial(self.continue_login, login_id),
+                login_id=login_id,
+            )
+
+        return structures.SteamTokenResponse(
+            token=response['token'],
+            refresh_token=response.get('refreshToken'),
+            callback=None,
+        )
+
+    async def generate_token(self, credentials: dict) -> structures.SteamTokenResponse:
+        login_id = next(self.ids)
+        return self.result(login_id, await self.request({'id': login_id, 'credentials': credentials}))
+
+    async def continue_login(self, login_id: int, code: str) -> structures.SteamTokenResponse:
+        return self.result(login_id, await self.request({'id': login_id, 'code': code}))
+
+    async def close(self):
+        for connection in self.connections:
+            connection.close()
+
+        self.connections.clear()
+
+
+token_service = TokenServiceClient(
+    Config.TOKEN_SERVICE_PATH,
+    Config.TOKEN_SERVICE_POOL_SIZE,
+    Config.TOKEN_SERVICE_TIMEOUT,
+    Config.TOKEN_SERVICE_CONCURRENCY,
+)
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import typing as tp
+from datetime import datetime, timedelta
+
+import orjson
+from aiogram import Bot
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql import delete, select
+
+from mimbus import cache, models
+from mimbus.config import Config
+from mimbus.utils import engine, session_scope, format_exception
+
+# a single INSERT ... ON CONFLICT instead of merge's SELECT and UPDATE, where the dialect has one
+UPSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+PRIMARY_KEY = [column.name for column in models.FSMState.__table__.primary_key]
+
+
+class SQLStorage(BaseStorage):
+    logger = logging.getLogger('mimbus.storage')
+
+    def __init__(self):
+        # this process's own writes go through it; the TTL bounds how long another process's writes stay unseen
+        self.cache: cache.TTLCache[StorageKey, tuple[str | None, dict[str, tp.Any]]] = cache.TTLCache(
+            Config.FSM_CACHE_SIZE, Config.FSM_CACHE_TTL,
+        )
+        self.task: asyncio.Task | None = None
+
+    @staticmethod
+    def where(key: StorageKey) -> tuple:
+        return (
+            models.FSMState.bot_id == key.bot_id,
+            models.FSMState.chat_id == key.chat_id,
+            models.FSMState.user_id == key.user_id,
+            models.FSMState.destiny == key.destiny,
+        )
+
+    async def load(self, key: StorageKey) -> tuple[str | None, dict[str, tp.Any]]:
+        if (record := self.cache.get(key)) is not None:
+            return record
+
+        async with session_scope(autocommit=False) as session:
+            row = (await session.execute(select(models.FSMState.state, models.FSMState.data).where(*self.where(key)))).first()
+
+        record = (None, {}) if row is None else (row.state, orjson.loads(row.data) if row.data else {})
+        self.cache.set(key, record)
+        return record
+
+    async def save(self, key: StorageKey, state: str | None, data: dict[str, tp.Any]):
+        values = {
+            'state': state,
+            'data': orjson.dumps(data).decode() if data else None,
+            'updated_at': datetime.now(),
+        }
+
+        async with session_scope() as session:
+            if state is None and not data:
+                await session.execute(delete(models.FSMState).where(*self.where(key)))
+            elif (insert := UPSERTS.get(engine.dialect.name)) is not None:
+                query = insert(models.FSMState).values(
+                    bot_id=key.bot_id, chat_id=key.chat_id, user_id=key.user_id, destiny=key.destiny, **values,
+                )
+                await session.execute(query.on_conflict_do_update(index_elements=PRIMARY_KEY, set_=values))
+            else:
+                await session.merge(models.FSMState(
+                    bot_id=key.bot_id, chat_id=key.chat_id, user_id=key.user_id, destiny=key.destiny, **values,
+                ))
+
+        # written through, so the next get_state/get_data of this process needs no round trip
+        self.cache.set(key, (state, data))
+
+    async def set_state(self, bot: Bot, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        current, data = await self.load(key)
+        if state != current:
+            await self.save(key, state, data)
+
+    async def get_state(self, bot: Bot, key: StorageKey) -> str | None:
+        state, _ = await self.load(key)
+        return state
+
+    async def set_data(self, bot: Bot, key: StorageKey, data: dict[str, tp.Any]) -> None:
+        state, current = await self.load(key)
+        if data != current:
+            await self.save(key, state, data.copy())
+
+    async def get_data(self, bot: Bot, key: StorageKey) -> dict[str, tp.Any]:
+        _, data = await self.load(key)
+        return data.copy()
+
+    async def evict(self):
+        # conversations abandoned halfway are not worth keeping forever
+        threshold = datetime.now() - timedelta(seconds=Config.FSM_STATE_TTL)
+        async with session_scope() as session:
+            result = await session.execute(delete(models.FSMState).where(models.FSMState.updated_at < threshold))
+
+        self.logger.debug('Evicted %s stale FSM states', result.rowcount)
+
+    async def loop(self):
+        while True:
+            try:
+                await self.evict()
+            except Exception as e:
+                self.logger.error('Unable to evict FSM states. Error: %s', format_exception(e))
+
+            await asyncio.sleep(60 * 60)
+
+    def start(self):
+        self.task = asyncio.create_task(self.loop())
+
+    async def close(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+
+
+class GuardSessions:
+    # Steam logins waiting for a guard code by Telegram user; only the token service login id is kept,
+    # so any bot process sharing the database can continue the login
+    async def put(self, session: AsyncSession, user_id: int, login_id: int):
+        await self.evict(session)
+        await session.merge(models.GuardSession(user_id=user_id, login_id=login_id, created_at=datetime.now()))
+
+    async def pop(self, session: AsyncSession, user_id: int) -> int | None:
+        guard = await session.get(models.GuardSession, user_id)
+        if guard is None:
+            return None
+
+        await session.delete(guard)
+        await session.flush()
+
+        if guard.created_at < datetime.now() - timedelta(seconds=Config.GUARD_SESSION_TTL):
+            return None
+
+        return guard.login_id
+
+    async def evict(self, session: AsyncSession):
+        # the token service gives up on these at about the same time
+        threshold = datetime.now() - timedelta(seconds=Config.GUARD_SESSION_TTL)
+        await session.execute(delete(models.GuardSession).where(models.GuardSession.created_at < threshold))
+
+        # the newest sessions win once the cap is reached
+        overflow = select(models.GuardSession.user_id).order_by(
+            models.GuardSession.created_at.desc(),
+        ).offset(
+            Config.GUARD_SESSION_LIMIT - 1,
+        )
+        await session.execute(delete(models.GuardSession).where(models.GuardSession.user_id.in_(overflow)))
+
+
+def create_storage() -> BaseStorage:
+    if Config.FSM_STORAGE == 'memory':
+        return MemoryStorage()
+
+    return SQLStorage()
@@ -1,3 +1,4 @@
+import functools
 import pydantic
 import typing as tp
 
@@ -7,10 +8,38 @@ def to_camel(snake_str: str) -> str:
     return components[0] + ''.join(x.title() for x in components[1:])
 
 
+def lazy(raw: str, type_: tp.Any) -> property:
+    # validates a raw JSON sub-tree on first access, so sections nobody reads are never parsed;
+    # decoded values live in a private attribute, which keeps them out of .dict() and .json()
+    def getter(self: 'LazyModel'):
+        if raw not in self._decoded:
+            self._decoded[raw] = pydantic.parse_obj_as(type_, getattr(self, raw))
+
+        return self._decoded[raw]
+
+    return property(getter)
+
+
+class LazyModel(pydantic.BaseModel):
+    # sections every caller reads, decoded by parse_obj so that a malformed response fails before it is cached
+    EAGER: tp.ClassVar[tuple[str, ...]] = ()
+
+    _decoded: dict[str, tp.Any] = pydantic.PrivateAttr(default_factory=dict)
+
+    @classmethod
+    def parse_obj(cls, obj: tp.Any):
+        model = super().parse_obj(obj)
+        for path in cls.EAGER:
+            functools.reduce(getattr, path.split('.'), model)
+
+        return model
+
+
 class SteamTokenResponse(pydantic.BaseModel):
     token: str | None
     refresh_token: str | None
     callback: tp.Optional[tp.Callable]
+    login_id: int | None = None
 
 
 class MimbusBaseResponse(pydantic.BaseModel):
@@ -64,12 +93,12 @@ class MailList(pydantic.BaseModel):
     parameters: list
 
 
-class Update(pydantic.BaseModel):
-    user_info: UserInfo
-    mail_list: list[MailList]
+class Update(LazyModel):
+    raw_user_info: dict = pydantic.Field(alias='userInfo')
+    raw_mail_list: list = pydantic.Field(alias='mailList')
 
-    class Config:
-        alias_generator = to_camel
+    user_info = lazy('raw_user_info', UserInfo)
+    mail_list = lazy('raw_mail_list', list[MailList])
 
 
 class Profile(pydantic.BaseModel):
@@ -83,10 +112,17 @@ class Profile(pydantic.BaseModel):
     date: str
 
 
-class LoadAllResults(pydantic.BaseModel):
-    profile: Profile
+class LoadAllResults(LazyModel):
+    raw_profile: dict = pydantic.Field(alias='profile')
+
+    profile = lazy('raw_profile', Profile)
+
+
+class LoadAllResponse(MimbusBaseResponse, LazyModel):
+    EAGER = ('updated.user_info', 'result.profile')
 
+    raw_updated: dict = pydantic.Field(alias='updated')
+    raw_result: dict = pydantic.Field(alias='result')
 
-class LoadAllResponse(MimbusBaseResponse):
-    updated: Update
-    result: LoadAllResults
+    updated = lazy('raw_updated', Update)
+    result = lazy('raw_result', LoadAllResults)
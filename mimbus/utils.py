@@ -1,17 +1,23 @@
 import asyncio
+import collections
 import contextlib
+import contextvars
 import functools
-import json
-import struct
+import itertools
+import random
 import sys
+import time
 import traceback
+import typing as tp
 
+import sqlalchemy
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import Session
 
 from mimbus.config import Config
-from mimbus.exceptions import SteamException
 from mimbus import structures
+from mimbus.steam import token_service
 
 
 Base = declarative_base()
@@ -19,76 +25,186 @@ engine = create_async_engine(Config.DB_URL, echo=Config.DEBUG)
 
 
 async def generate_token(credentials: dict) -> structures.SteamTokenResponse:
-    reader, writer = await asyncio.open_unix_connection('/tmp/mimbus-token.sock')
+    return await token_service.generate_token(credentials)
 
-    req = json.dumps({'credentials': credentials}).encode()
-    writer.write(struct.pack('>I', len(req)) + req)
 
-    length = struct.unpack('>I', await reader.read(4))[0]
-    response = json.loads((await reader.read(length)).decode())
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
 
-    if err := response.get('error'):
-        raise SteamException(err)
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
 
-    if response.get('guard'):
+    @property
+    def full(self) -> bool:
+        self.refill()
+        return self.tokens >= self.capacity
 
-        async def callback(code: str):
-            request = json.dumps({'code': code}).encode()
-            writer.write(struct.pack('>I', len(request)) + request)
+    def delay(self, tokens: float = 1.) -> float:
+        self.refill()
+        return max(0., (tokens - self.tokens) / self.rate)
 
-            _length = struct.unpack('>I', await reader.read(4))[0]
-            _response = json.loads((await reader.read(_length)).decode())
+    def consume(self, tokens: float = 1.) -> bool:
+        if self.delay(tokens) > 0:
+            return False
 
-            if _err := _response.get('error'):
-                raise SteamException(_err)
+        self.tokens -= tokens
+        return True
 
-            if _response.get('guard'):
-                return None, callback
+    async def acquire(self, tokens: float = 1.):
+        while not self.consume(tokens):
+            await asyncio.sleep(self.delay(tokens))
 
-            return structures.SteamTokenResponse(
-                token=_response['token'],
-                refresh_token=_response.get('refreshToken'),
-                callback=None
-            )
 
-        return structures.SteamTokenResponse(
-            token=None,
-            refresh_token=None,
-            callback=callback
-        )
+class SingleFlight:
+    def __init__(self):
+        self.calls: dict[tp.Hashable, asyncio.Future] = {}
 
-    return structures.SteamTokenResponse(
-        token=response['token'],
-        refresh_token=response.get('refreshToken'),
-        callback=None,
-    )
+    async def do(self, key: tp.Hashable, func: tp.Callable[[], tp.Awaitable[tp.Any]]) -> tp.Any:
+        if (future := self.calls.get(key)) is None:
+            future = self.calls[key] = asyncio.ensure_future(func())
+            future.add_done_callback(functools.partial(self.done, key))
 
+        # one cancelled waiter must not cancel the shared call for the others
+        return await asyncio.shield(future)
 
-def retry(times: int = 6, exceptions: tuple = (Exception,)):
+    def done(self, key: tp.Hashable, future: asyncio.Future):
+        if self.calls.get(key) is future:
+            del self.calls[key]
+
+    def forget(self, key: tp.Hashable):
+        # later callers start a new call instead of joining the one in flight
+        self.calls.pop(key, None)
+
+
+class KeyedLock:
+    def __init__(self):
+        self.locks: dict[tp.Hashable, asyncio.Lock] = {}
+        self.holders: collections.Counter[tp.Hashable] = collections.Counter()
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, key: tp.Hashable):
+        if (lock := self.locks.get(key)) is None:
+            lock = self.locks[key] = asyncio.Lock()
+
+        # locks live only while someone holds or awaits them
+        self.holders[key] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.holders[key] -= 1
+            if not self.holders[key]:
+                del self.holders[key]
+                del self.locks[key]
+
+
+user_locks = KeyedLock()
+
+
+class RetryPolicy(tp.NamedTuple):
+    times: int = Config.RETRY_ATTEMPTS
+    base_delay: float = Config.RETRY_BASE_DELAY
+    max_delay: float = Config.RETRY_MAX_DELAY
+    deadline: float = Config.RETRY_DEADLINE
+
+    def delay(self, attempt: int) -> float:
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+deadline_var: contextvars.ContextVar[float | None] = contextvars.ContextVar('deadline', default=None)
+retry_budget = TokenBucket(Config.RETRY_BUDGET_RATE, Config.RETRY_BUDGET_BURST)
+retry_metrics: collections.Counter[tuple[str, str]] = collections.Counter()
+
+
+def remaining(timeout: float) -> float:
+    if (deadline := deadline_var.get()) is None:
+        return timeout
+
+    return min(timeout, deadline - time.monotonic())
+
+
+def retry(policy: RetryPolicy = RetryPolicy(), exceptions: tuple = (Exception,)):
     def decorator(func):
+        name = func.__qualname__
+
         @functools.wraps(func)
         async def wrapper(*args, **kwargs):
-            for _ in range(times - 1):
-                try:
-                    return await func(*args, **kwargs)
-                except exceptions:
-                    continue
-
-            return await func(*args, **kwargs)
+            deadline = time.monotonic() + policy.deadline
+            if (outer := deadline_var.get()) is not None:
+                deadline = min(deadline, outer)
+
+            token = deadline_var.set(deadline)
+            try:
+                for attempt in itertools.count():
+                    try:
+                        return await func(*args, **kwargs)
+                    except exceptions:
+                        if attempt + 1 >= policy.times:
+                            retry_metrics[name, 'exhausted'] += 1
+                            raise
+
+                        delay = policy.delay(attempt)
+                        if time.monotonic() + delay >= deadline:
+                            retry_metrics[name, 'deadline'] += 1
+                            raise
+
+                        # a process-wide budget keeps an outage from turning into a retry storm
+                        if not retry_budget.consume():
+                            retry_metrics[name, 'budget'] += 1
+                            raise
+
+                        retry_metrics[name, 'retry'] += 1
+                        await asyncio.sleep(delay)
+            finally:
+                deadline_var.reset(token)
 
         return wrapper
 
     return decorator
 
 
+@sqlalchemy.event.listens_for(Session, 'after_flush')
+def mark_flushed(session: Session, _):
+    session.info['flushed'] = True
+
+
+def on_commit(session: AsyncSession, callback: tp.Callable[[], tp.Any]):
+    session.info.setdefault('on_commit', []).append(callback)
+
+
+def has_changes(session: AsyncSession) -> bool:
+    return bool(session.new or session.dirty or session.deleted or session.info.get('flushed'))
+
+
+async def commit(session: AsyncSession):
+    await session.commit()
+    session.info.pop('flushed', None)
+
+    for callback in session.info.pop('on_commit', ()):
+        callback()
+
+
+async def release(session: AsyncSession):
+    # returns the connection to the pool; loaded objects stay usable since sessions do not expire on commit
+    if session.in_transaction():
+        await commit(session)
+
+
 @contextlib.asynccontextmanager
 async def session_scope(autocommit=True):
-    async with AsyncSession(engine) as session:
+    async with generate_session() as session:
         try:
             yield session
 
             if autocommit:
-                await session.commit()
+                await commit(session)
 
         except:
             await session.rollback()
@@ -96,13 +212,34 @@ async def session_scope(autocommit=True):
 
 
 def generate_session():
-    return AsyncSession(engine)
+    return AsyncSession(engine, expire_on_commit=False)
 
 
 async def prepare_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
 
+        # create_all skips existing tables entirely, including columns and indexes added to them later
+        await conn.run_sync(add_missing_columns)
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                await conn.run_sync(index.create, checkfirst=True)
+
+
+def add_missing_columns(conn: sqlalchemy.Connection):
+    inspector = sqlalchemy.inspect(conn)
+    preparer = conn.dialect.identifier_preparer
+
+    for table in Base.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+
+            # only nullable columns without constraints can be added in place, which is all this is used for
+            ddl = sqlalchemy.schema.CreateColumn(column).compile(dialect=conn.dialect)
+            conn.execute(sqlalchemy.text(f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {ddl}'))
+
 
 async def drop_db():
     async with engine.begin() as conn:
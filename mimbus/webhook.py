@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import typing as tp
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+from mimbus.config import Config
+from mimbus.utils import format_exception
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    # an update is acknowledged as soon as it is read and processed in the background, but only while one of
+    # `concurrency` slots is free; otherwise Telegram gets a 503 and delivers the update again later
+    logger = logging.getLogger('mimbus.webhook')
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, concurrency: int, secret_token: str | None = None, **data: tp.Any):
+        super().__init__(dispatcher, bot, handle_in_background=True, **data)
+        self.secret_token = secret_token
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.tasks: set[asyncio.Task] = set()
+        self.closing = False
+
+    async def process(self, bot: Bot, update: dict[str, tp.Any]):
+        try:
+            await self._background_feed_update(bot=bot, update=update)
+        except Exception as e:
+            self.logger.error('Unable to process update %s. Error: %s', update.get('update_id'), format_exception(e, with_traceback=True))
+        finally:
+            self.semaphore.release()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret_token and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret_token:
+            return web.Response(status=401)
+
+        if self.closing or self.semaphore.locked():
+            return web.Response(status=503)
+
+        bot = await self.resolve_bot(request)
+        update = await request.json(loads=bot.session.json_loads)
+
+        # taken before the ack and without waiting, so the number of accepted updates never exceeds the bound
+        if self.closing or self.semaphore.locked():
+            return web.Response(status=503)
+        await self.semaphore.acquire()
+
+        task = asyncio.create_task(self.process(bot, update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    __call__ = handle
+
+    async def close(self) -> None:
+        # new updates are refused, and the accepted ones are finished since Telegram will not send them again
+        self.closing = True
+        if self.tasks:
+            self.logger.info('Waiting for %s accepted updates', len(self.tasks))
+            await asyncio.wait(self.tasks)
+
+        await super().close()
+
+
+def create_app(dp: Dispatcher, bot: Bot, **data: tp.Any) -> web.Application:
+    app = web.Application()
+
+    handler = BoundedRequestHandler(dp, bot, Config.WEBHOOK_CONCURRENCY, Config.WEBHOOK_SECRET, **data)
+    handler.register(app, path=Config.WEBHOOK_PATH)
+
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, **data: tp.Any):
+    logger = logging.getLogger('mimbus.webhook')
+
+    runner = web.AppRunner(create_app(dp, bot, **data))
+    await runner.setup()
+    await web.TCPSite(runner, Config.WEBHOOK_HOST, Config.WEBHOOK_PORT).start()
+    logger.info('Serving webhook on %s:%s%s', Config.WEBHOOK_HOST, Config.WEBHOOK_PORT, Config.WEBHOOK_PATH)
+
+    # without a public url the server only takes updates posted to it locally
+    if Config.WEBHOOK_URL:
+        await bot.set_webhook(
+            f'{Config.WEBHOOK_URL}{Config.WEBHOOK_PATH}',
+            allowed_updates=dp.resolve_used_update_types(),
+            secret_token=Config.WEBHOOK_SECRET,
+            max_connections=min(Config.WEBHOOK_CONCURRENCY, 100),
+        )
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,24 @@
+import io
+
+import pytest
+
+from mimbus.proxy import iter_json_array
+
+DOCUMENT = '[1, 23, 456, true, false, null, -7.5e3, "a,b", {"k": [1, 2]}, ["x"]]'
+ITEMS = [1, 23, 456, True, False, None, -7.5e3, 'a,b', {'k': [1, 2]}, ['x']]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 7, 64 * 1024])
+def test_items_split_across_chunks(chunk_size):
+    assert list(iter_json_array(io.StringIO(DOCUMENT), chunk_size)) == ITEMS
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 64 * 1024])
+def test_empty_array(chunk_size):
+    assert list(iter_json_array(io.StringIO(' [ ] '), chunk_size)) == []
+
+
+@pytest.mark.parametrize('document', ['[1, 2', '[1, 23', '{"a": 1}', ''])
+def test_malformed(document):
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO(document), 1))
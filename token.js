@@ -1,5 +1,9 @@
 /**
  * Generating token for Mimbus
+ *
+ * Frames are a 4-byte big-endian length followed by a JSON object. Every request carries an `id`,
+ * and the response to it echoes the same `id`, so a connection can carry several logins at once.
+ * A guard code is sent with the `id` of the login it continues, on any connection.
  */
 
 const AppTicket = require('steam-appticket');
@@ -7,6 +11,10 @@ const SteamUser = require('steam-user');
 const net = require('net');
 
 const APP_ID = 2 * 5 * 13 * 17 * 19 * 47;  // Mimbus app id
+const LOGIN_TTL = 10 * 60 * 1000;  // logins waiting for a guard code longer than this are dropped
+
+// in-flight logins by request id
+const logins = new Map();
 
 function buf2hex(buffer) { // buffer is an ArrayBuffer
     return [...new Uint8Array(buffer)]
@@ -25,93 +33,129 @@ async function getToken(client) {
     return hexTicket
 }
 
-let unixServer = net.createServer(async (socket) => {
-    try {
-        let client = new SteamUser({dataDirectory: 'sentry_files', debug: true});
+function send(socket, response) {
+    if (socket.destroyed) {
+        return;
+    }
 
-        let guardCallback = undefined;
-        let rememberPassword = false;
+    let payload = Buffer.from(JSON.stringify(response));
+    let header = Buffer.alloc(4);
+    header.writeUInt32BE(payload.length, 0);
 
-        // read steam credentials from socket
-        socket.on('data', (data) => {
-            let length = data.readInt32LE(0);
-            let request = JSON.parse(data.slice(4, length + 4).toString());
+    socket.write(Buffer.concat([header, payload]));
+}
 
-            if (request.code) {
-                guardCallback(request.code);
-            } else if (request.credentials) {
-                client.logOn(request.credentials);
+function finish(id) {
+    let login = logins.get(id);
+    if (login === undefined) {
+        return;
+    }
 
-                if (request.credentials.rememberPassword) {
-                    rememberPassword = true;
-                }
-            }
-        });
+    clearTimeout(login.timer);
+    logins.delete(id);
+    login.client.logOff();
+}
+
+function startLogin(id, socket, credentials) {
+    let client = new SteamUser({dataDirectory: 'sentry_files', debug: true});
+    let login = {client: client, socket: socket, guardCallback: undefined, timer: undefined};
+
+    login.timer = setTimeout(() => finish(id), LOGIN_TTL);
+    logins.set(id, login);
 
-        client.on('loggedOn', async function () {
+    client.on('loggedOn', async function () {
+        try {
             let token = await getToken(client);
 
             let refreshToken = null;
-            if (rememberPassword) {
+            if (credentials.rememberPassword) {
                 refreshToken = await new Promise(resolve => client.on('loginKey', resolve));
             }
 
-            let response = JSON.stringify({token: token, refreshToken: refreshToken});
-            let length = Buffer.byteLength(response);
+            send(login.socket, {id: id, token: token, refreshToken: refreshToken});
+        } catch (e) {
+            send(login.socket, {id: id, error: e.message});
+        }
 
-            const buffer = new ArrayBuffer(4);
-            const view = new DataView(buffer);
-            view.setInt32(0, length);
+        finish(id);
+    });
 
-            client.logOff();
+    client.on('error', function (err) {
+        console.error(err)
+        send(login.socket, {id: id, error: err.message});
+        finish(id);
+    });
 
-            socket.write(Buffer.concat([Buffer.from(buffer), Buffer.from(response)]));
-            socket.end();
-        });
+    client.on('steamGuard', function (_, callback) {
+        console.log('Guard required');
+        login.guardCallback = callback;
+        send(login.socket, {id: id, guard: true});
+    });
 
-        client.on('error', function (err) {
-            console.error(err)
-            let response = JSON.stringify({error: err.message});
-            let length = Buffer.byteLength(response);
+    client.logOn(credentials);
+}
 
-            const buffer = new ArrayBuffer(4);
-            const view = new DataView(buffer);
-            view.setInt32(0, length);
+function handle(socket, request) {
+    let id = request.id;
 
-            socket.write(Buffer.concat([Buffer.from(buffer), Buffer.from(response)]));
-        });
+    try {
+        if (request.code) {
+            let login = logins.get(id);
+            if (login === undefined || login.guardCallback === undefined) {
+                send(socket, {id: id, error: 'Login session expired'});
+                return;
+            }
 
-        client.on('steamGuard', function (_, callback) {
-            console.log('Guard required');
-            let response = JSON.stringify({guard: true});
-            let length = Buffer.byteLength(response);
+            // the answer goes back wherever the code came from
+            login.socket = socket;
+            login.guardCallback(request.code);
+        } else if (request.credentials) {
+            startLogin(id, socket, request.credentials);
+        }
+    } catch (e) {
+        send(socket, {id: id, error: e.message});
+    }
+}
 
-            const buffer = new ArrayBuffer(4);
-            const view = new DataView(buffer);
-            view.setInt32(0, length);
+let unixServer = net.createServer((socket) => {
+    let buffer = Buffer.alloc(0);
 
-            socket.write(Buffer.concat([Buffer.from(buffer), Buffer.from(response)]));
+    socket.on('data', (data) => {
+        buffer = Buffer.concat([buffer, data]);
 
-            guardCallback = callback;
-        });
+        // a chunk may carry part of a frame or several of them
+        while (buffer.length >= 4) {
+            let length = buffer.readUInt32BE(0);
+            if (buffer.length < length + 4) {
+                break;
+            }
 
-    } catch (e) {
-        let response = JSON.stringify({error: e.message});
-        let length = Buffer.byteLength(response);
+            let frame = buffer.subarray(4, length + 4);
+            buffer = buffer.subarray(length + 4);
 
-        const buffer = new ArrayBuffer(4);
-        const view = new DataView(buffer);
-        view.setInt32(0, length);
+            let request;
+            try {
+                request = JSON.parse(frame.toString());
+            } catch (e) {
+                console.error(e);
+                continue;
+            }
 
-        socket.write(Buffer.concat([Buffer.from(buffer), Buffer.from(response)]));
-    }
+            handle(socket, request);
+        }
+    });
 
+    socket.on('error', (err) => console.error(err));
 });
 
 // start unix socket server
 unixServer.listen('/tmp/mimbus-token.sock');
 
 process.on('SIGINT', function () {
+    for (let id of [...logins.keys()]) {
+        finish(id);
+    }
+
     unixServer.close();
     process.exit();
 });